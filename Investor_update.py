@@ -3,189 +3,73 @@ import streamlit as st
 from datetime import datetime
 import tempfile
 import re
-from pathlib import Path
+import time
+import textwrap
 from docx import Document
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 import openai
-from langchain.schema import Document as LangchainDocument
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import FAISS
 from langchain.chains import RetrievalQA
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
 from dotenv import load_dotenv
-
-# Try to import PDF reader
-try:
-    from PyPDF2 import PdfReader
-    PDF_AVAILABLE = True
-except ImportError:
-    PDF_AVAILABLE = False
+from clients import get_async_openai_client, get_chat_model, get_openai_embeddings
+from document_cache import get_document_cache
+from document_loaders import load_documents_from_uploads
+from embedding_pipeline import PipelinedEmbeddings
+from llm_cache import get_llm_cache
+from local_retrieval import get_local_embeddings
+from rag_index import DEFAULT_RETRIEVAL_BACKEND, RETRIEVAL_BACKENDS, get_session_index
+from section_generation import (SECTION_QA_PROMPT, SectionPrompt, UsageTracker, generate_sections,
+                                generate_sections_single_call)
 
 # Load environment variables
 env_path = os.path.join(os.path.dirname(__file__), ".env")
 load_dotenv(dotenv_path=env_path)
 
 
-def load_documents_from_uploads(uploaded_files, storage_key="investor"):
-    """Load documents from uploaded files and store in session state with app-specific key"""
-    docs = []
-    
-    if not uploaded_files:
-        return docs
-    
-    # Use app-specific storage keys
-    docs_key = f'processed_docs_{storage_key}'
-    names_key = f'processed_file_names_{storage_key}'
-    
-    # Check if files are already processed in session state
-    current_file_names = [f.name for f in uploaded_files]
-    if docs_key in st.session_state and names_key in st.session_state:
-        if st.session_state[names_key] == current_file_names:
-            return st.session_state[docs_key]
-    
-    for uploaded_file in uploaded_files:
-        try:
-            # Create temporary file
-            with tempfile.NamedTemporaryFile(delete=False, suffix=f".{uploaded_file.name.split('.')[-1]}") as tmp:
-                tmp.write(uploaded_file.read())
-                tmp_path = tmp.name
-            
-            # Process based on file type
-            if uploaded_file.name.lower().endswith('.pdf'):
-                if PDF_AVAILABLE:
-                    result = load_pdf_safe(tmp_path)
-                    docs.extend(result)
-                else:
-                    with st.sidebar:
-                        st.warning(f"⏭️ Skipping PDF {uploaded_file.name} (PyPDF2 not installed)")
-            
-            elif uploaded_file.name.lower().endswith('.docx'):
-                result = load_docx_safe(tmp_path)
-                docs.extend(result)
-            
-            elif uploaded_file.name.lower().endswith(('.txt', '.md')):
-                result = load_text_safe(tmp_path)
-                docs.extend(result)
-            
-            # Clean up temp file
-            os.unlink(tmp_path)
-            
-        except Exception as e:
-            with st.sidebar:
-                st.warning(f"❌ Error loading {uploaded_file.name}: {str(e)}")
-    
-    # Store processed documents in session state with app-specific keys
-    st.session_state[docs_key] = docs
-    st.session_state[names_key] = current_file_names
-    
-    return docs
-
-
-def load_pdf_safe(file_path):
-    """Safely load PDF using PyPDF2"""
-    docs = []
+def load_rag_engine_with_docs(ledger, storage_key, temperature, sources=None, backend=DEFAULT_RETRIEVAL_BACKEND,
+                              streaming=False):
+    """Initialize RAG engine with the session's ingested documents"""
+    # The session index follows the ingestion ledger: new files are embedded,
+    # removed files have their vectors deleted, untouched files are left alone.
+    # Built stores are shared process-wide by corpus fingerprint, so only the
+    # LLM wrapper below depends on temperature and sliders never re-embed.
+    embedder, mode = RETRIEVAL_BACKENDS[backend]
+    index = get_session_index(storage_key, embedder)
     try:
-        reader = PdfReader(str(file_path))
-        text = ""
-        for page_num, page in enumerate(reader.pages):
-            try:
-                page_text = page.extract_text()
-                text += f"\n--- Page {page_num + 1} ---\n{page_text}\n"
-            except Exception as e:
-                with st.sidebar:
-                    st.warning(f"Error reading page {page_num + 1} of {Path(file_path).name}: {e}")
-
-        if text.strip():
-            docs.append(LangchainDocument(
-                page_content=text,
-                metadata={"source": str(file_path), "type": "pdf"}
-            ))
-    except Exception as e:
-        with st.sidebar:
-            st.error(f"Error reading PDF {Path(file_path).name}: {e}")
-    return docs
-
-
-def load_docx_safe(file_path):
-    """Safely load DOCX file"""
-    docs = []
-    try:
-        doc = Document(str(file_path))
-        text = "\n".join([paragraph.text for paragraph in doc.paragraphs if paragraph.text.strip()])
-
-        if text.strip():
-            docs.append(LangchainDocument(
-                page_content=text,
-                metadata={"source": str(file_path), "type": "docx"}
-            ))
-    except Exception as e:
-        with st.sidebar:
-            st.error(f"Error reading DOCX {Path(file_path).name}: {e}")
-    return docs
-
-
-def load_text_safe(file_path):
-    """Safely load text file"""
-    docs = []
-    try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            text = f.read()
-
-        if text.strip():
-            docs.append(LangchainDocument(
-                page_content=text,
-                metadata={"source": str(file_path), "type": "text"}
-            ))
+        if embedder == "openai":
+            # New chunks are embedded in concurrent token-budgeted batches; show live throughput
+            progress_text = st.sidebar.empty()
+            api_key = os.getenv("OPENAI_API_KEY") or st.secrets.get("OPENAI_API_KEY")
+            embeddings = PipelinedEmbeddings(
+                get_openai_embeddings(api_key),
+                on_progress=lambda p: progress_text.caption(
+                    f"🧮 Embedded {p['done']}/{p['total']} chunks · "
+                    f"{p['chunks_per_sec']:.0f} chunks/s · {p['tokens_per_sec']:.0f} tokens/s"
+                ),
+                client=get_async_openai_client(api_key)
+            )
+        elif embedder == "local":
+            embeddings = get_local_embeddings()
+        else:
+            embeddings = None
+        index.sync(ledger, embeddings)
     except Exception as e:
         with st.sidebar:
-            st.error(f"Error reading text file {Path(file_path).name}: {e}")
-    return docs
-
-
-@st.cache_resource
-def load_rag_engine_with_docs(_docs, temperature):
-    """Initialize RAG engine with provided documents"""
-    if not _docs:
-        # Create a simple LLM without retrieval
-        return ChatOpenAI(
-            model_name='gpt-4o-mini',
-            temperature=temperature,
-            api_key=os.getenv("OPENAI_API_KEY") or st.secrets.get("OPENAI_API_KEY")
-        )
-
-    # Split into chunks
-    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    chunks = splitter.split_documents(_docs)
+            st.error(f"Error creating RAG engine: {e}")
 
-    try:
-        # Create embeddings + vector store
-        embeddings = OpenAIEmbeddings(api_key=os.getenv("OPENAI_API_KEY") or st.secrets.get("OPENAI_API_KEY"))
-        vectorstore = FAISS.from_documents(chunks, embeddings)
-
-        # Setup LLM and RetrievalQA
-        llm = ChatOpenAI(
-            model_name='gpt-4o-mini',
-            temperature=temperature,
-            api_key=os.getenv("OPENAI_API_KEY") or st.secrets.get("OPENAI_API_KEY")
-        )
+    # Shared process-wide per configuration; connections are pooled across reruns and sessions
+    llm = get_chat_model('gpt-4o-mini', os.getenv("OPENAI_API_KEY") or st.secrets.get("OPENAI_API_KEY"), temperature, streaming=streaming)
+    if index.empty:
+        # No indexed documents - use the LLM without retrieval
+        return llm
+
+    rag_chain = RetrievalQA.from_chain_type(
+        llm=llm,
+        chain_type='stuff',
+        retriever=index.as_retriever(sources, mode),
+        chain_type_kwargs={"prompt": SECTION_QA_PROMPT}
+    )
 
-        rag_chain = RetrievalQA.from_chain_type(
-            llm=llm,
-            chain_type='stuff',
-            retriever=vectorstore.as_retriever()
-        )
-
-        return rag_chain
-
-    except Exception as e:
-        with st.sidebar:
-            st.error(f"Error creating RAG engine: {e}")
-        # Fallback to simple LLM
-        return ChatOpenAI(
-            model_name='gpt-4o-mini',
-            temperature=temperature,
-            api_key=os.getenv("OPENAI_API_KEY") or st.secrets.get("OPENAI_API_KEY")
-        )
+    return rag_chain
 
 
 def render_investor_ui():
@@ -195,6 +79,7 @@ def render_investor_ui():
     # Constants
     UPDATE_TYPES = ["Monthly Update", "Quarterly Update", "Milestone Update", "Board Update"]
     LENGTH_MAP = {"Brief": "200-300 words", "Standard": "400-600 words", "Detailed": "700-900 words"}
+    GENERATION_MODES = ["One call per topic", "Single structured call"]
 
     # Comprehensive system prompt for Naware
     NAWARE_SYSTEM_PROMPT = """
@@ -246,6 +131,15 @@ def render_investor_ui():
         include_metrics = st.checkbox("Include Metrics Dashboard", True)
         include_financials = st.checkbox("Include Financial Summary", True)
         tone = st.selectbox("Tone", ["Optimistic", "Balanced", "Conservative"], index=0)
+        generation_mode = st.selectbox(
+            "Generation Mode", GENERATION_MODES, index=0,
+            help="Single structured call retrieves once for all topics and writes every section in one request"
+        )
+        # Last run of each mode, for comparing latency and token spend
+        for mode, stats in st.session_state.get('investor_generation_stats', {}).items():
+            st.caption(f"{mode}: {stats['seconds']:.1f}s · {stats['input_tokens']:,} prompt "
+                       f"({stats['cached_tokens']:,} cached) + {stats['output_tokens']:,} completion tokens "
+                       f"in {stats['calls']} calls")
 
     # --- Document Upload in Sidebar ---
     st.sidebar.header("📁 Upload Documents")
@@ -270,19 +164,54 @@ def render_investor_ui():
                 del st.session_state['processed_docs_investor']
             if 'processed_file_names_investor' in st.session_state:
                 del st.session_state['processed_file_names_investor']
+            for key in list(st.session_state.keys()):
+                if key == 'ingest_ledger_investor' or key.startswith('vector_index_investor_'):
+                    del st.session_state[key]
             st.rerun()
     
-    # Document processing - check session state first
-    all_docs = []
-    if uploaded_files:
-        all_docs = load_documents_from_uploads(uploaded_files, "investor")
-    elif 'processed_docs_investor' in st.session_state:
-        # Use previously processed documents if no new files uploaded
-        all_docs = st.session_state['processed_docs_investor']
+    # Parse new uploads into the ingestion ledger, which the RAG engine indexes
+    load_documents_from_uploads(uploaded_files, "investor")
+
+    # Parse-cache counters are process-wide, shared by every session and app
+    cache_stats = get_document_cache().stats()
+    if cache_stats['hits'] or cache_stats['misses']:
+        st.sidebar.caption(f"♻️ Parse cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses")
+
+    ledger = st.session_state.get('ingest_ledger_investor', {})
+    retrieval_backend = st.sidebar.selectbox(
+        "Retrieval backend", list(RETRIEVAL_BACKENDS),
+        index=list(RETRIEVAL_BACKENDS).index(DEFAULT_RETRIEVAL_BACKEND),
+        help="Offline backends index without calling the embeddings API", key="investor_retrieval_backend"
+    )
+
+    # Optionally search only some of the uploaded files
+    retrieval_sources = []
+    if len(ledger) > 1:
+        retrieval_sources = st.sidebar.multiselect(
+            "Search only these files", sorted({name for name, _ in ledger}),
+            help="Leave empty to search all uploaded files", key="investor_retrieval_sources"
+        )
+
+    stream_sections = st.sidebar.checkbox(
+        "Stream sections as they're written", True,
+        help="Show each section live instead of waiting for all of them", key="investor_stream_sections"
+    )
+    bypass_cache = st.sidebar.checkbox(
+        "Bypass response cache", False,
+        help="Always call the model; fresh responses still replace cached ones", key="investor_bypass_llm_cache"
+    )
+    llm_cache_stats = get_llm_cache().stats("investor")
+    if llm_cache_stats['hits'] or llm_cache_stats['semantic_hits'] or llm_cache_stats['misses']:
+        st.sidebar.caption(
+            f"💾 Response cache: {llm_cache_stats['hit_rate']:.0%} hit rate "
+            f"({llm_cache_stats['hits']} exact, {llm_cache_stats['semantic_hits']} similar, "
+            f"{llm_cache_stats['misses']} misses)"
+        )
 
     # Initialize RAG engine with uploaded documents
     try:
-        rag_chain = load_rag_engine_with_docs(all_docs, temperature)
+        rag_chain = load_rag_engine_with_docs(ledger, "investor", temperature, retrieval_sources, retrieval_backend,
+                                              stream_sections)
     except Exception as e:
         st.sidebar.error(f"❌ RAG Engine Error: {e}")
         rag_chain = None
@@ -349,19 +278,30 @@ def render_investor_ui():
             st.error("RAG engine not initialized. Please check your OpenAI API key.")
             return None, None
 
-        all_sections = []
+        topics = list(st.session_state['investor_topics'])
         progress_bar = st.progress(0)
         status_text = st.empty()
-
-        for idx, topic in enumerate(st.session_state['investor_topics']):
-            status_text.text(f"Generating content for: {topic}")
-
-            # Create professional prompt for each topic
-            prompt = f"""
-            {NAWARE_SYSTEM_PROMPT}
-
-            Generate a {LENGTH_MAP[update_length]} professional section for an investor update covering "{topic}".
-
+        status_text.text(f"Generating {len(topics)} sections...")
+        cache_scope = get_llm_cache().scope("investor", bypass_cache)
+        usage = UsageTracker()
+        context_stats = []
+        started = time.perf_counter()
+        completed = []
+
+        def on_section_done(idx, result_text, error):
+            completed.append(idx)
+            if placeholders:
+                placeholders[idx].markdown(result_text if error is None else "⚠️ Generation failed")
+            if error is not None:
+                st.error(f"Error generating content for '{topics[idx]}': {error}")
+            status_text.text(f"Finished {len(completed)} of {len(topics)}: {topics[idx]}")
+            progress_bar.progress(len(completed) / len(topics))
+
+        # Prompts run from most to least stable (system prompt, shared requirements, this
+        # request's settings and topic, then retrieved context) so repeated calls share a
+        # byte-identical prefix the provider can cache
+        system_prompt = textwrap.dedent(NAWARE_SYSTEM_PROMPT).strip()
+        requirements = textwrap.dedent("""
             Requirements:
             - Use formal business language appropriate for institutional investors
             - Include specific quantitative metrics and performance data
@@ -372,45 +312,79 @@ def render_investor_ui():
             - Use professional terminology and avoid casual expressions
             - Include forward-looking statements with appropriate caveats
 
-            Section Topic: {topic}
-            Update Type: {update_type}
-            Communication Tone: {tone} and Professional
-            Reporting Period: {update_date.strftime('%B %Y')}
-
             Format the response with clear structure and professional business language suitable for investor communications.
-            """
-
-            try:
-                if hasattr(rag_chain, 'invoke'):
-                    result = rag_chain.invoke(prompt)  # Pass string directly, not dict
-                elif hasattr(rag_chain, 'run'):
-                    result = rag_chain.run(prompt)
-                else:
-                    # Fallback for simple ChatOpenAI
-                    result = rag_chain.predict(prompt)
-
-                # Extract text content from result
-                if isinstance(result, dict):
-                    result_text = result.get('result', '') or result.get('answer', '') or str(result)
-                elif hasattr(result, 'content'):
-                    # Handle LangChain response object with content attribute
-                    result_text = result.content
-                else:
-                    result_text = str(result)
+        """).strip()
+        settings = (
+            f"Update Type: {update_type}\n"
+            f"Communication Tone: {tone} and Professional\n"
+            f"Reporting Period: {update_date.strftime('%B %Y')}"
+        )
+
+        placeholders = []
+        if generation_mode == "Single structured call":
+            # Shared brief, retrieval and system prompt are sent once for every topic
+            prompt = SectionPrompt(
+                system_prompt, requirements,
+                f"Generate {LENGTH_MAP[update_length]} professional sections for an investor update, "
+                f"one for each topic listed below.\n{settings}"
+            )
+            results = generate_sections_single_call(rag_chain, topics, prompt, cache_scope, [usage], context_stats)
+            for idx, (result_text, error) in enumerate(results):
+                on_section_done(idx, result_text, error)
+        else:
+            prompts = [
+                SectionPrompt(
+                    system_prompt, requirements,
+                    f"Generate a {LENGTH_MAP[update_length]} professional section for an investor update "
+                    f"covering \"{topic}\".\n{settings}\nSection Topic: {topic}"
+                )
+                for topic in topics
+            ]
+            results = generate_topic_sections(topics, prompts, on_section_done, placeholders, cache_scope, usage,
+                                              context_stats)
 
+        elapsed = time.perf_counter() - started
+        st.session_state.setdefault('investor_generation_stats', {})[generation_mode] = {
+            "seconds": elapsed, "calls": usage.calls, "input_tokens": usage.input_tokens,
+            "cached_tokens": usage.cached_tokens, "output_tokens": usage.output_tokens,
+        }
+
+        all_sections = []
+        for topic, (result_text, error) in zip(topics, results):
+            if error is None:
                 # Clean and structure the result
                 paragraphs = [p.strip() for p in re.split(r'\n\n|\n', result_text) if p.strip()]
                 all_sections.append((topic, paragraphs))
 
-            except Exception as e:
-                st.error(f"Error generating content for '{topic}': {e}")
-                continue
-
-            progress_bar.progress((idx + 1) / len(st.session_state['investor_topics']))
-
-        status_text.text("Update generated successfully!")
+        status_text.text(f"Update generated in {elapsed:.1f}s using {usage.input_tokens:,} prompt "
+                         f"({usage.cached_tokens:,} cached) + {usage.output_tokens:,} completion tokens")
+        if usage.records:
+            with st.expander("Token usage per call"):
+                st.table(usage.records)
+        if context_stats:
+            with st.expander("Retrieved context per section"):
+                st.table(context_stats)
         return all_sections, create_docx_update(all_sections)
 
+    def generate_topic_sections(topics, prompts, on_section_done, placeholders, cache_scope, usage, context_stats):
+        """One concurrent (optionally streamed) call per topic"""
+        # Live draft of every section while streaming; replaced by the preview once done
+        live_draft = st.empty()
+        if stream_sections:
+            with live_draft.container():
+                for topic in topics:
+                    st.markdown(f"#### {topic}")
+                    placeholders.append(st.empty())
+
+        def on_partial(idx, partial_text):
+            placeholders[idx].markdown(partial_text + " ▌")
+
+        # Sections run concurrently; results come back in topic order
+        results = generate_sections(rag_chain, prompts, on_section_done, on_partial if stream_sections else None,
+                                    cache_scope, [usage], context_stats)
+        live_draft.empty()
+        return results
+
     def create_docx_update(sections):
         """Create a professionally formatted DOCX document for investors"""
         doc = Document()
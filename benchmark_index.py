@@ -0,0 +1,112 @@
+"""Compare faiss index types on a corpus: memory, build time, query latency and recall vs exact search.
+
+    python benchmark_index.py docs/*.pdf
+    python benchmark_index.py docs/*.pdf --factories "Flat;HNSW32;IVF{nlist},SQ8" --openai
+
+Chunks are embedded once and every index type is built from the same
+vectors. "recall" is the overlap of the top k with exact (Flat) search;
+"known-item" is how often the chunk a query sentence was sampled from comes
+back in the top k. Put the chosen string in RAG_INDEX_FACTORY.
+"""
+import os
+import time
+import argparse
+
+import numpy as np
+from dotenv import load_dotenv
+
+from benchmark_retrieval import sample_queries
+from document_cache import content_key
+from document_loaders import parse_document
+from local_retrieval import get_local_embeddings
+from rag_index import IncrementalVectorIndex, index_memory_bytes, make_faiss_index
+
+load_dotenv()
+
+# Separated by ";" since factory strings contain commas
+DEFAULT_FACTORIES = "Flat;SQ8;HNSW32;HNSW32,SQ8;IVF{nlist},Flat;IVF{nlist},SQ8;IVF{nlist},PQ32;PCA256,IVF{nlist},SQ8"
+
+
+def benchmark(factory, vectors, query_vectors, exact, targets, k):
+    started = time.perf_counter()
+    index = make_faiss_index(vectors, factory)
+    index.add(vectors)
+    build_seconds = time.perf_counter() - started
+
+    latencies = []
+    found = []
+    for query in query_vectors:
+        started = time.perf_counter()
+        _, positions = index.search(query[None, :], k)
+        latencies.append(time.perf_counter() - started)
+        found.append(positions[0])
+    latencies.sort()
+
+    recall = np.mean([len(set(f) & set(e)) / len(e) for f, e in zip(found, exact)])
+    known_item = np.mean([t in f for f, t in zip(found, targets)])
+    return {
+        "index": type(index).__name__,
+        "mb": index_memory_bytes(index) / 1e6,
+        "build_s": build_seconds,
+        "recall": recall,
+        "known_item": known_item,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95)] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--factories", default=DEFAULT_FACTORIES, help="faiss index_factory strings separated by ;")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--openai", action="store_true", help="Embed with OpenAI instead of the local embedder")
+    args = parser.parse_args()
+
+    splitter = IncrementalVectorIndex()
+    chunks = []
+    for path in args.files:
+        with open(path, 'rb') as f:
+            data = f.read()
+        name = os.path.basename(path)
+        chunks += splitter.split_file((name, content_key(data, name)), parse_document(data, name))
+    if not chunks:
+        parser.error("no text found in the given files")
+
+    if args.openai:
+        from langchain_openai import OpenAIEmbeddings
+        from embedding_pipeline import PipelinedEmbeddings
+        embeddings = PipelinedEmbeddings(OpenAIEmbeddings(api_key=os.getenv("OPENAI_API_KEY")))
+    else:
+        embeddings = get_local_embeddings()
+
+    texts = [chunk.page_content for _, chunk in chunks]
+    position = {(chunk.metadata.get("source"), chunk.page_content): i for i, (_, chunk) in enumerate(chunks)}
+    queries = sample_queries(chunks, args.queries, args.seed)
+    vectors = np.array(embeddings.embed_documents(texts), dtype=np.float32)
+    query_vectors = np.array([embeddings.embed_query(query) for query, _ in queries], dtype=np.float32)
+    targets = [position[target] for _, target in queries]
+
+    # Ground truth: exact nearest neighbours
+    exact_index = make_faiss_index(vectors, "Flat")
+    exact_index.add(vectors)
+    _, exact = exact_index.search(query_vectors, args.k)
+
+    print(f"{len(chunks)} chunks x {vectors.shape[1]} dims, {len(queries)} queries, k={args.k}\n")
+    print(f"{'factory':<24} {'index':<26} {'MB':>8} {'build s':>8} {'recall':>7} {'known':>7} "
+          f"{'p50 ms':>8} {'p95 ms':>8}")
+    for factory in args.factories.split(";"):
+        factory = factory.strip()
+        try:
+            r = benchmark(factory, vectors, query_vectors, exact, targets, args.k)
+        except RuntimeError as e:
+            print(f"{factory:<24} failed: {str(e).splitlines()[0]}")
+            continue
+        print(f"{factory:<24} {r['index']:<26} {r['mb']:8.2f} {r['build_s']:8.2f} {r['recall']:7.3f} "
+              f"{r['known_item']:7.3f} {r['p50_ms']:8.3f} {r['p95_ms']:8.3f}")
+
+
+if __name__ == "__main__":
+    main()
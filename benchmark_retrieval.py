@@ -0,0 +1,105 @@
+"""Compare retrieval backends on a corpus: index build time, query latency and known-item recall.
+
+    python benchmark_retrieval.py docs/Naware.pdf docs/ExecutiveSummary.pdf
+    python benchmark_retrieval.py docs/*.pdf --queries 300 --k 4 --openai
+
+Each query is one sentence sampled from a chunk, and that chunk is the only
+correct answer, so no hand-labelled relevance data is needed. Indexes are
+built in a temporary directory and nothing is written to the real cache.
+"""
+import os
+import re
+import time
+import random
+import argparse
+import tempfile
+
+from dotenv import load_dotenv
+
+from document_cache import content_key
+from document_loaders import parse_document
+from local_retrieval import get_local_embeddings
+from rag_index import IncrementalVectorIndex, IndexRegistry
+
+load_dotenv()
+
+SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+
+
+def sample_queries(chunks, count, seed=0):
+    """[(query, target)] using one sentence of 8+ words from each chunk; target is (source, text)"""
+    rng = random.Random(seed)
+    candidates = []
+    for _, chunk in chunks:
+        sentences = [s.strip() for s in SENTENCE_RE.split(chunk.page_content) if len(s.split()) >= 8]
+        if sentences:
+            candidates.append((rng.choice(sentences), (chunk.metadata.get("source"), chunk.page_content)))
+    rng.shuffle(candidates)
+    return candidates[:count]
+
+
+def run_backend(files, embeddings, mode, queries, k):
+    with tempfile.TemporaryDirectory() as index_dir:
+        index = IncrementalVectorIndex(index_dir=index_dir, registry=IndexRegistry())
+        started = time.perf_counter()
+        index.sync(files, embeddings)
+        build_seconds = time.perf_counter() - started
+
+        retriever = index.as_retriever(mode=mode, k=k)
+        hits = 0
+        latencies = []
+        for query, target in queries:
+            started = time.perf_counter()
+            docs = retriever.invoke(query)
+            latencies.append(time.perf_counter() - started)
+            hits += any((doc.metadata.get("source"), doc.page_content) == target for doc in docs)
+
+    latencies.sort()
+    return {
+        "chunks": len(index.chunks),
+        "build_s": build_seconds,
+        "chunks_per_s": len(index.chunks) / max(build_seconds, 1e-9),
+        "recall": hits / max(len(queries), 1),
+        "p50_ms": latencies[len(latencies) // 2] * 1000 if latencies else 0.0,
+        "p95_ms": latencies[int(len(latencies) * 0.95)] * 1000 if latencies else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--openai", action="store_true", help="Also benchmark OpenAI embeddings (needs OPENAI_API_KEY)")
+    args = parser.parse_args()
+
+    files = {}
+    for path in args.files:
+        with open(path, 'rb') as f:
+            data = f.read()
+        name = os.path.basename(path)
+        files[(name, content_key(data, name))] = parse_document(data, name)
+
+    local = get_local_embeddings()
+    backends = [("bm25", None, "bm25"), ("local", local, "vector"), ("hybrid bm25+local", local, "hybrid")]
+    if args.openai:
+        from langchain_openai import OpenAIEmbeddings
+        openai_embeddings = OpenAIEmbeddings(api_key=os.getenv("OPENAI_API_KEY"))
+        backends += [("openai", openai_embeddings, "vector"), ("hybrid bm25+openai", openai_embeddings, "hybrid")]
+
+    # Sample queries once so every backend answers the same questions
+    splitter = IncrementalVectorIndex()
+    chunks = [item for key, docs in files.items() for item in splitter.split_file(key, docs)]
+    queries = sample_queries(chunks, args.queries, args.seed)
+    print(f"{len(chunks)} chunks, {len(queries)} queries, recall@{args.k}\n")
+
+    print(f"{'backend':<20} {'build s':>8} {'chunks/s':>10} {'recall':>7} {'p50 ms':>8} {'p95 ms':>8}")
+    for label, embeddings, mode in backends:
+        r = run_backend(files, embeddings, mode, queries, args.k)
+        print(f"{label:<20} {r['build_s']:8.2f} {r['chunks_per_s']:10.0f} {r['recall']:7.3f} "
+              f"{r['p50_ms']:8.2f} {r['p95_ms']:8.2f}")
+
+
+if __name__ == "__main__":
+    main()
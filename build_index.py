@@ -0,0 +1,104 @@
+"""Pre-build and garbage-collect the on-disk RAG indexes used by the Newsletter and Investor apps.
+
+    python build_index.py build docs/Naware.pdf docs/ExecutiveSummary.pdf
+    python build_index.py build --index-factory "IVF{nlist},SQ8" docs/*.pdf
+    python build_index.py list
+    python build_index.py gc --max-age-days 30 --max-mb 2048
+
+Indexes are keyed by the same corpus fingerprint the apps compute, so
+building one here for a set of files means uploading exactly those files
+(same names, same bytes) loads it instead of re-embedding. An index built
+with --index-factory is only picked up by apps running with the same
+RAG_INDEX_FACTORY.
+"""
+import os
+import argparse
+from datetime import datetime
+
+from dotenv import load_dotenv
+from langchain_openai import OpenAIEmbeddings
+
+from document_cache import content_key
+from document_loaders import parse_document
+from embedding_cache import EmbeddingStore
+from embedding_pipeline import PipelinedEmbeddings
+from rag_index import INDEX_DIR, INDEX_FACTORY, IncrementalVectorIndex, gc_indexes, index_memory_bytes, list_indexes
+
+load_dotenv()
+
+
+def build(paths, index_dir, index_factory):
+    files = {}
+    for path in paths:
+        with open(path, 'rb') as f:
+            data = f.read()
+        name = os.path.basename(path)
+        docs = parse_document(data, name)
+        files[(name, content_key(data, name))] = docs
+        print(f"Parsed {name}: {len(docs)} documents")
+
+    index = IncrementalVectorIndex(index_dir=index_dir, embedding_store=EmbeddingStore(), index_factory=index_factory)
+    embeddings = PipelinedEmbeddings(
+        OpenAIEmbeddings(api_key=os.getenv("OPENAI_API_KEY")),
+        on_progress=lambda p: print(
+            f"  embedded {p['done']}/{p['total']} chunks  {p['chunks_per_sec']:.0f} chunks/s  "
+            f"{p['tokens_per_sec']:.0f} tokens/s  ({p['retries']} retries)")
+    )
+    index.sync(files, embeddings)
+    if index.vectorstore is None:
+        print("No text to index")
+        return
+    state = "already built" if index.loaded_from_disk else "built"
+    print(f"Index {index.fingerprint} {state}: {len(index.chunks)} chunks, "
+          f"{type(index.vectorstore.index).__name__} {index_memory_bytes(index.vectorstore.index) / 1e6:.1f} MB "
+          f"in {index_dir}")
+
+
+def show(index_dir):
+    for meta in list_indexes(index_dir):
+        last_used = datetime.fromtimestamp(meta.get("last_used", 0)).strftime('%Y-%m-%d %H:%M')
+        files = ", ".join(meta.get("files", []))
+        print(f"{meta['fingerprint'][:12]}  {meta['size_bytes'] / 1e6:8.1f} MB  "
+              f"{meta.get('chunks', '?'):>6} chunks  {meta.get('index', 'IndexFlat'):<24} "
+              f"last used {last_used}  {files}")
+
+
+def gc(index_dir, max_age_days, max_mb, dry_run):
+    max_bytes = int(max_mb * 1024 * 1024) if max_mb is not None else None
+    removed = gc_indexes(index_dir, max_age_days=max_age_days, max_bytes=max_bytes, dry_run=dry_run)
+    verb = "Would remove" if dry_run else "Removed"
+    for meta in removed:
+        print(f"{verb} {meta['fingerprint'][:12]} ({meta['size_bytes'] / 1e6:.1f} MB)")
+    print(f"{verb} {len(removed)} index(es)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--index-dir", default=INDEX_DIR)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = sub.add_parser("build", help="Embed and save an index for a set of files")
+    build_parser.add_argument("--index-factory", default=INDEX_FACTORY,
+                              help="faiss index_factory string, e.g. Flat, HNSW32, IVF{nlist},SQ8")
+    build_parser.add_argument("files", nargs="+")
+
+    sub.add_parser("list", help="Show saved indexes")
+
+    gc_parser = sub.add_parser("gc", help="Delete stale indexes")
+    gc_parser.add_argument("--max-age-days", type=float, default=None)
+    gc_parser.add_argument("--max-mb", type=float, default=None)
+    gc_parser.add_argument("--dry-run", action="store_true")
+
+    args = parser.parse_args()
+    if args.command == "build":
+        build(args.files, args.index_dir, args.index_factory)
+    elif args.command == "list":
+        show(args.index_dir)
+    elif args.command == "gc":
+        if args.max_age_days is None and args.max_mb is None:
+            parser.error("gc needs --max-age-days and/or --max-mb")
+        gc(args.index_dir, args.max_age_days, args.max_mb, args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import os
+
+import httpx
+import streamlit as st
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from openai import AsyncOpenAI
+
+from pipedrive_client import PipedriveClient, pipedrive_base_url
+from pipedrive_mirror import PipedriveMirror, mirror_path
+
+# Keep-alive connections held open per pool
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 20))
+# Idle pooled connections are closed after this many seconds
+HTTP_KEEPALIVE_SECONDS = float(os.getenv("HTTP_KEEPALIVE_SECONDS", 60))
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", 120))
+
+
+@st.cache_resource
+def get_http_client():
+    """Pooled keep-alive HTTP client shared by every OpenAI model and embedder in this process"""
+    return httpx.Client(
+        limits=httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE,
+                            keepalive_expiry=HTTP_KEEPALIVE_SECONDS),
+        timeout=OPENAI_TIMEOUT_SECONDS,
+    )
+
+
+@st.cache_resource
+def get_async_openai_client(api_key):
+    """Pooled AsyncOpenAI for the embedding pipeline, shared by every session and run.
+
+    Retries are off: the pipeline retries itself, honouring Retry-After across
+    all in-flight requests. It only runs on the pipeline's event loop.
+    """
+    return AsyncOpenAI(
+        api_key=api_key,
+        max_retries=0,
+        http_client=httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE,
+                                keepalive_expiry=HTTP_KEEPALIVE_SECONDS),
+            timeout=OPENAI_TIMEOUT_SECONDS,
+        ),
+    )
+
+
+@st.cache_resource
+def get_chat_model(model, api_key, temperature=0.7, max_tokens=None, streaming=False):
+    """Process-wide ChatOpenAI per configuration, so reruns and sessions skip client construction.
+
+    Per-call state (callbacks) is passed at invoke time, so instances are safe to share.
+    """
+    return ChatOpenAI(
+        model_name=model,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        streaming=streaming,
+        stream_usage=True,
+        api_key=api_key,
+        http_client=get_http_client(),
+    )
+
+
+@st.cache_resource
+def get_openai_embeddings(api_key):
+    return OpenAIEmbeddings(api_key=api_key, http_client=get_http_client())
+
+
+@st.cache_resource
+def get_pipedrive_client(domain, api_token):
+    """Pipedrive client per account, matching orgs against a local mirror first.
+
+    Its deal cache, mirror and connection pool are shared by every session.
+    """
+    client = PipedriveClient(pipedrive_base_url(domain), api_token)
+    client.mirror = PipedriveMirror(client, mirror_path(domain))
+    return client
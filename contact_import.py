@@ -0,0 +1,95 @@
+import io
+import re
+import uuid
+
+import pandas as pd
+
+EMAIL_RE = re.compile(r'^[\w\.-]+@[\w\.-]+\.\w+$')
+PRODUCTS = ["Wipe All", "AI-driven solution"]
+
+# Accepted spellings of each column, compared lowercased with punctuation and spacing removed
+COLUMN_ALIASES = {
+    "name": ["name", "fullname", "contact", "contactname", "attendee"],
+    "email": ["email", "emailaddress", "mail"],
+    "org": ["org", "organization", "organisation", "company", "companyname"],
+    "demo_date": ["demodate", "date", "demo"],
+    "cta": ["cta", "ctalink", "link", "schedulinglink"],
+    "product": ["product", "productdemod", "productdemoed"],
+}
+REQUIRED_COLUMNS = ("name", "email", "org")
+
+
+def read_table(data, filename):
+    """Every cell of an uploaded CSV or XLSX as a string; blank cells are empty strings"""
+    if filename.lower().endswith((".xlsx", ".xls")):
+        return pd.read_excel(io.BytesIO(data), dtype=str).fillna("")
+    return pd.read_csv(io.BytesIO(data), dtype=str, keep_default_na=False, skipinitialspace=True,
+                       encoding="utf-8-sig")
+
+
+def normalize_columns(df):
+    """Rename recognised headers to contact field names; unrecognised columns are dropped"""
+    lookup = {alias: field for field, aliases in COLUMN_ALIASES.items() for alias in aliases}
+    renames = {}
+    for column in df.columns:
+        field = lookup.get(re.sub(r"[^a-z]", "", str(column).lower()))
+        if field and field not in renames.values():
+            renames[column] = field
+    return df[list(renames)].rename(columns=renames)
+
+
+def prepare_contacts(df, default_date, default_cta="", default_product=PRODUCTS[0], existing_emails=()):
+    """Validate and de-duplicate imported rows; returns (contacts, errors).
+
+    All checks run column-wise. Each demo date is parsed on its own, so a
+    sheet may mix formats; ambiguous numeric dates are read month first.
+    Rows are de-duplicated by lowercased email, against existing_emails and
+    against earlier rows that pass every other check. errors is a DataFrame
+    of (row, email, error), where row is the spreadsheet row number.
+    """
+    df = normalize_columns(df)
+    missing = [field for field in REQUIRED_COLUMNS if field not in df.columns]
+    if missing:
+        raise ValueError(f"Missing column(s): {', '.join(missing)}")
+    for field in COLUMN_ALIASES:
+        df[field] = df[field].astype(str).str.strip() if field in df.columns else ""
+
+    df["cta"] = df["cta"].mask(df["cta"] == "", default_cta)
+    product_lower = {p.lower(): p for p in PRODUCTS}
+    products = df["product"].str.lower().map(product_lower)
+    bad_product = products.isna() & (df["product"] != "")
+    df["product"] = products.fillna(default_product)
+    dates = pd.to_datetime(df["demo_date"].mask(df["demo_date"] == ""), errors="coerce", format="mixed",
+                           dayfirst=False)
+    bad_date = dates.isna() & (df["demo_date"] != "")
+    df["demo_date"] = dates.dt.date.astype(object).where(dates.notna(), default_date)
+
+    email_key = df["email"].str.lower()
+    checks = [
+        (df["name"] == "", "missing name"),
+        (df["org"] == "", "missing organization"),
+        (~df["email"].str.match(EMAIL_RE), "invalid email"),
+        (df["cta"] == "", "missing CTA link"),
+        (bad_date, "unreadable demo date"),
+        (bad_product, "unknown product"),
+        (email_key.isin({e.lower() for e in existing_emails}), "already in contacts"),
+    ]
+    messages = pd.Series("", index=df.index)
+    for mask, message in checks:
+        messages = messages.mask(mask, messages + "; " + message)
+    # Only repeats of a row that is itself kept are duplicates
+    passing = messages == ""
+    duplicate = email_key[passing].duplicated().reindex(df.index, fill_value=False)
+    messages = messages.mask(duplicate, "; duplicate email in file")
+    invalid = messages != ""
+
+    errors = pd.DataFrame({
+        "row": df.index[invalid] + 2,  # 1-based, after the header row
+        "email": df.loc[invalid, "email"],
+        "error": messages[invalid].str.removeprefix("; "),
+    })
+    valid = df.loc[~invalid, list(COLUMN_ALIASES)]
+    contacts = valid.to_dict("records")
+    for contact in contacts:
+        contact["id"] = uuid.uuid4().hex
+    return contacts, errors.reset_index(drop=True)
@@ -0,0 +1,156 @@
+import os
+import re
+import logging
+
+from langchain_core.documents import Document
+
+from embedding_pipeline import token_counter
+from local_retrieval import tokenize
+
+logger = logging.getLogger(__name__)
+
+# Retrieved-context tokens allowed per section prompt
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 1200))
+# What to do when merged context is still over budget: "trim", "compress" or "map_reduce"
+CONTEXT_STRATEGY = os.getenv("CONTEXT_STRATEGY", "trim")
+CONTEXT_STRATEGIES = ("trim", "compress", "map_reduce")
+if CONTEXT_STRATEGY not in CONTEXT_STRATEGIES:
+    CONTEXT_STRATEGY = "trim"
+# A truncated excerpt shorter than this is dropped rather than kept
+MIN_EXCERPT_TOKENS = 50
+
+SENTENCE_RE = re.compile(r'(?<=[.!?])\s+|\n{2,}')
+MAP_PROMPT = (
+    "Extract the facts, figures and quotes from these excerpts that are relevant to: {query}\n"
+    "Reply with short bullet points only, or NONE if nothing is relevant.\n\n{excerpts}"
+)
+
+count_tokens = token_counter()
+
+
+def budget_key(budget=CONTEXT_TOKEN_BUDGET, strategy=CONTEXT_STRATEGY):
+    """Part of the response-cache context key, so changing either re-generates"""
+    return f"{strategy}:{budget}"
+
+
+def merge_overlapping(docs):
+    """Drop duplicates and stitch chunks whose character ranges overlap, keeping rank order.
+
+    Chunks carry absolute char_start/char_end offsets into their file; two
+    chunks of the same source and page that overlap or touch are merged
+    into the earlier-ranked one.
+    """
+    merged = []
+    seen = set()
+    spans = {}  # (source, page) -> [index into merged]
+    for doc in docs:
+        key = (doc.metadata.get("source"), doc.page_content)
+        if key in seen:
+            continue
+        seen.add(key)
+        start, end = doc.metadata.get("char_start"), doc.metadata.get("char_end")
+        group = (doc.metadata.get("source"), doc.metadata.get("page"))
+        if start is None or end is None:
+            merged.append(doc)
+            continue
+        for i in spans.get(group, []):
+            target = merged[i]
+            t_start, t_end = target.metadata["char_start"], target.metadata["char_end"]
+            if start > t_end or end < t_start:
+                continue
+            if start >= t_start and end <= t_end:
+                break
+            if start < t_start:
+                text = doc.page_content[:t_start - start] + target.page_content
+                t_start = start
+            else:
+                text = target.page_content
+            if end > t_end:
+                text += doc.page_content[len(doc.page_content) - (end - t_end):]
+                t_end = end
+            merged[i] = Document(page_content=text,
+                                 metadata={**target.metadata, "char_start": t_start, "char_end": t_end})
+            break
+        else:
+            spans.setdefault(group, []).append(len(merged))
+            merged.append(doc)
+    return merged
+
+
+def fit_to_budget(docs, budget):
+    """Keep documents in rank order until the budget is spent, truncating the last at a word boundary"""
+    kept = []
+    remaining = budget
+    for doc in docs:
+        tokens = count_tokens(doc.page_content)
+        if tokens <= remaining:
+            kept.append(doc)
+            remaining -= tokens
+            continue
+        if remaining >= MIN_EXCERPT_TOKENS:
+            # Token counts scale roughly with length, so cut proportionally then back off to whitespace
+            text = doc.page_content[:int(len(doc.page_content) * remaining / tokens)]
+            text = text[:text.rfind(" ")] if " " in text else text
+            kept.append(Document(page_content=text + " …", metadata=doc.metadata))
+        break
+    return kept
+
+
+def compress(docs, query):
+    """Keep only the sentences sharing a term with the query; documents with none are dropped"""
+    terms = set(tokenize(query))
+    compressed = []
+    for doc in docs:
+        sentences = [s for s in SENTENCE_RE.split(doc.page_content) if terms & set(tokenize(s))]
+        if sentences:
+            compressed.append(Document(page_content=" ".join(sentences), metadata=doc.metadata))
+    return compressed
+
+
+def map_reduce(docs, query, llm, budget, callbacks=None):
+    """Summarise budget-sized groups of documents into relevant notes in one batched LLM call"""
+    groups = [[]]
+    size = 0
+    for doc in docs:
+        tokens = count_tokens(doc.page_content)
+        if groups[-1] and size + tokens > budget:
+            groups.append([])
+            size = 0
+        groups[-1].append(doc)
+        size += tokens
+    prompts = [MAP_PROMPT.format(query=query, excerpts="\n\n".join(doc.page_content for doc in group))
+               for group in groups]
+    replies = llm.batch(prompts, config={"callbacks": callbacks} if callbacks else None)
+    notes = []
+    for group, reply in zip(groups, replies):
+        text = getattr(reply, "content", str(reply)).strip()
+        if text and text.upper() != "NONE":
+            sources = sorted({str(doc.metadata.get("source", "")) for doc in group})
+            notes.append(Document(page_content=text, metadata={"source": ", ".join(sources)}))
+    return notes
+
+
+def assemble_context(docs, query, budget=CONTEXT_TOKEN_BUDGET, strategy=CONTEXT_STRATEGY, llm=None,
+                     callbacks=None):
+    """Merge, then shrink retrieved documents to the token budget; returns (docs, stats).
+
+    "compress" and "map_reduce" only run when merged context is over budget;
+    map_reduce needs llm and falls back to compress without one. Whatever
+    remains is trimmed to the budget. stats has tokens and chunk counts before
+    and after, and is logged.
+    """
+    before = sum(count_tokens(doc.page_content) for doc in docs)
+    assembled = merge_overlapping(docs)
+    merged_tokens = sum(count_tokens(doc.page_content) for doc in assembled)
+    if merged_tokens > budget:
+        if strategy == "map_reduce" and llm is not None:
+            assembled = map_reduce(assembled, query, llm, budget, callbacks)
+        elif strategy in ("compress", "map_reduce"):
+            assembled = compress(assembled, query) or assembled
+        assembled = fit_to_budget(assembled, budget)
+    after = sum(count_tokens(doc.page_content) for doc in assembled)
+    stats = {"query": query[:80], "strategy": strategy, "chunks_before": len(docs), "chunks_after": len(assembled),
+             "tokens_before": before, "tokens_after": after}
+    logger.info("Context for %r: %d -> %d tokens (%d -> %d chunks, %s, budget %d)",
+                stats["query"], before, after, len(docs), len(assembled), strategy, budget)
+    return assembled, stats
@@ -0,0 +1,174 @@
+import os
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+
+import streamlit as st
+from langchain.schema import Document as LangchainDocument
+
+# Memory budget for parsed text held in-process (characters of page_content)
+DEFAULT_MAX_CHARS = int(os.getenv("PARSED_DOC_CACHE_MAX_CHARS", 50_000_000))
+# Optional on-disk tier, shared across process restarts when set
+DEFAULT_CACHE_DIR = os.getenv("PARSED_DOC_CACHE_DIR")
+DEFAULT_MAX_DISK_BYTES = int(os.getenv("PARSED_DOC_CACHE_MAX_DISK_BYTES", 1_000_000_000))
+
+# Bump when loader output changes shape so stale on-disk entries are ignored
+PARSER_VERSION = 2
+
+
+def content_key(data, file_name):
+    """Cache key for an upload: SHA-256 of its bytes plus the extension that picks the parser"""
+    ext = file_name.rsplit('.', 1)[-1].lower() if '.' in file_name else ''
+    return f"{hashlib.sha256(data).hexdigest()}-{ext}-v{PARSER_VERSION}"
+
+
+class ParsedDocumentCache:
+    """Process-wide LRU cache of parsed upload text keyed by content hash"""
+
+    def __init__(self, max_chars=DEFAULT_MAX_CHARS, cache_dir=DEFAULT_CACHE_DIR,
+                 max_disk_bytes=DEFAULT_MAX_DISK_BYTES):
+        self.max_chars = max_chars
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = OrderedDict()
+        self._chars = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get(self, key):
+        """Return fresh LangchainDocuments for key, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._to_documents(entry)
+
+        entry = self._read_disk(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self.hits += 1
+            self._insert(key, entry)
+        return self._to_documents(entry)
+
+    def put(self, key, docs):
+        """Store parsed documents (text + metadata only) under key"""
+        entry = [(doc.page_content, dict(doc.metadata)) for doc in docs]
+        with self._lock:
+            self._insert(key, entry)
+        self._write_disk(key, entry)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "disk_hits": self.disk_hits,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "chars": self._chars,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._chars = 0
+
+    # ——— internals ————————————————————————————————————
+    @staticmethod
+    def _entry_size(entry):
+        return sum(len(text) for text, _ in entry)
+
+    @staticmethod
+    def _to_documents(entry):
+        # Hand out copies so one session can't mutate another's metadata
+        return [LangchainDocument(page_content=text, metadata=dict(meta)) for text, meta in entry]
+
+    def _insert(self, key, entry):
+        if key in self._entries:
+            self._chars -= self._entry_size(self._entries.pop(key))
+        size = self._entry_size(entry)
+        if size > self.max_chars:
+            # Larger than the whole budget: keep it on disk only
+            return
+        self._entries[key] = entry
+        self._chars += size
+        while self._chars > self.max_chars:
+            _, evicted = self._entries.popitem(last=False)
+            self._chars -= self._entry_size(evicted)
+            self.evictions += 1
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pkl")
+
+    def _read_disk(self, key):
+        if not self.cache_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+            os.utime(path)  # bump mtime so disk eviction is LRU too
+            return entry
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # Corrupt or partial file - drop it and re-parse
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            return None
+
+    def _write_disk(self, key, entry):
+        if not self.cache_dir:
+            return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+            self._evict_disk()
+        except OSError:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+    def _evict_disk(self):
+        files = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.pkl'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        files.sort()
+        while total > self.max_disk_bytes and files:
+            _, size, path = files.pop(0)
+            try:
+                os.unlink(path)
+                total -= size
+            except OSError:
+                pass
+
+
+@st.cache_resource
+def get_document_cache():
+    """Shared parsed-document cache for every session and app in this process"""
+    return ParsedDocumentCache()
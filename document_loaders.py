@@ -0,0 +1,190 @@
+import io
+import time
+
+import streamlit as st
+from docx import Document
+from langchain.schema import Document as LangchainDocument
+
+from document_cache import get_document_cache, content_key
+
+# Try to import PDF reader
+try:
+    from pdf_extract import extract_pdf_pages
+    PDF_AVAILABLE = True
+except ImportError:
+    PDF_AVAILABLE = False
+
+
+def load_documents_from_uploads(uploaded_files, storage_key):
+    """Load documents from uploaded files and store in session state with app-specific key"""
+    docs = []
+
+    if not uploaded_files:
+        return docs
+
+    # Use app-specific storage keys
+    docs_key = f'processed_docs_{storage_key}'
+    names_key = f'processed_file_names_{storage_key}'
+    ledger_key = f'ingest_ledger_{storage_key}'
+    hashes_key = f'upload_hashes_{storage_key}'
+
+    # Ingestion ledger: (file name, content hash) -> parsed docs for that file.
+    # Only files missing from it are parsed; files no longer uploaded drop out.
+    ledger = st.session_state.get(ledger_key, {})
+    upload_hashes = st.session_state.setdefault(hashes_key, {})
+    current_file_names = [f.name for f in uploaded_files]
+    new_ledger = {}
+
+    cache = get_document_cache()
+    for uploaded_file in uploaded_files:
+        # UploadedFile is an in-memory BytesIO; getvalue() hands back its buffer without a disk round-trip
+        data = None
+        # Hash each upload once per upload id rather than on every rerun
+        upload_id = getattr(uploaded_file, 'file_id', None)
+        cache_key = upload_hashes.get(upload_id) if upload_id else None
+        if cache_key is None:
+            data = uploaded_file.getvalue()
+            cache_key = content_key(data, uploaded_file.name)
+            if upload_id:
+                upload_hashes[upload_id] = cache_key
+
+        file_key = (uploaded_file.name, cache_key)
+        if file_key in ledger:
+            new_ledger[file_key] = ledger[file_key]
+            continue
+
+        result = []
+        try:
+            # Same bytes already parsed by any session or app - skip the parse
+            cached = cache.get(cache_key)
+            if cached is not None:
+                new_ledger[file_key] = cached
+                continue
+
+            if data is None:
+                data = uploaded_file.getvalue()
+
+            result = parse_document(data, uploaded_file.name)
+            if result:
+                cache.put(cache_key, result)
+
+        except Exception as e:
+            with st.sidebar:
+                st.warning(f"❌ Error loading {uploaded_file.name}: {str(e)}")
+
+        new_ledger[file_key] = result
+
+    docs = [doc for file_docs in new_ledger.values() for doc in file_docs]
+
+    # Store processed documents in session state with app-specific keys
+    st.session_state[ledger_key] = new_ledger
+    st.session_state[docs_key] = docs
+    st.session_state[names_key] = current_file_names
+
+    return docs
+
+
+def parse_document(data, file_name):
+    """Parse one file's bytes into Documents based on its extension"""
+    if file_name.lower().endswith('.pdf'):
+        if PDF_AVAILABLE:
+            return load_pdf_safe(data, file_name)
+        with st.sidebar:
+            st.warning(f"⏭️ Skipping PDF {file_name} (PyPDF2 not installed)")
+    elif file_name.lower().endswith('.docx'):
+        return load_docx_safe(data, file_name)
+    elif file_name.lower().endswith(('.txt', '.md')):
+        return load_text_safe(data, file_name)
+    return []
+
+
+def load_pdf_safe(data, file_name):
+    """Safely load PDF using PyPDF2, one Document per page"""
+    docs = []
+    try:
+        start_time = time.perf_counter()
+        # Parsed from memory; pool workers get a temp file path rather than the bytes
+        pages = extract_pdf_pages(data)
+
+        offset = 0
+        for page_num, page_text, error in pages:
+            if error:
+                with st.sidebar:
+                    st.warning(f"Error reading page {page_num + 1} of {file_name}: {error}")
+                continue
+            if page_text.strip():
+                docs.append(LangchainDocument(
+                    page_content=page_text,
+                    metadata={"source": file_name, "type": "pdf", "page": page_num + 1,
+                              "char_start": offset, "char_end": offset + len(page_text)}
+                ))
+            # Offsets are into the file's pages joined by newlines
+            offset += len(page_text) + 1
+
+        elapsed = time.perf_counter() - start_time
+        if pages and elapsed > 0:
+            st.sidebar.caption(f"📄 {file_name}: {len(pages)} pages in {elapsed:.1f}s ({len(pages) / elapsed:.0f} pages/s)")
+    except Exception as e:
+        with st.sidebar:
+            st.error(f"Error reading PDF {file_name}: {e}")
+    return docs
+
+
+def _is_heading(paragraph):
+    style_name = paragraph.style.name if paragraph.style is not None else ""
+    return style_name.startswith("Heading") or style_name == "Title"
+
+
+def load_docx_safe(data, file_name):
+    """Safely load DOCX file, one Document per heading section"""
+    docs = []
+    try:
+        doc = Document(io.BytesIO(data))
+
+        # Group non-empty paragraphs under the heading that precedes them
+        sections = []
+        heading, lines = None, []
+        for paragraph in doc.paragraphs:
+            if not paragraph.text.strip():
+                continue
+            if _is_heading(paragraph) and lines:
+                sections.append((heading, lines))
+                heading, lines = None, []
+            if _is_heading(paragraph):
+                heading = paragraph.text.strip()
+            lines.append(paragraph.text)
+        if lines:
+            sections.append((heading, lines))
+
+        offset = 0
+        for section_index, (heading, lines) in enumerate(sections):
+            text = "\n".join(lines)
+            docs.append(LangchainDocument(
+                page_content=text,
+                metadata={"source": file_name, "type": "docx", "section": heading or "",
+                          "section_index": section_index,
+                          "char_start": offset, "char_end": offset + len(text)}
+            ))
+            offset += len(text) + 1
+    except Exception as e:
+        with st.sidebar:
+            st.error(f"Error reading DOCX {file_name}: {e}")
+    return docs
+
+
+def load_text_safe(data, file_name):
+    """Safely load text file"""
+    docs = []
+    try:
+        # Universal newlines, as open(..., 'r') would have given
+        text = data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+
+        if text.strip():
+            docs.append(LangchainDocument(
+                page_content=text,
+                metadata={"source": file_name, "type": "text", "char_start": 0, "char_end": len(text)}
+            ))
+    except Exception as e:
+        with st.sidebar:
+            st.error(f"Error reading text file {file_name}: {e}")
+    return docs
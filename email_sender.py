@@ -0,0 +1,147 @@
+import os
+import ssl
+import time
+import smtplib
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+
+from rate_limit import TokenBucket
+
+# Sustained send rate and burst allowed by the SMTP provider
+SMTP_RATE_PER_SECOND = float(os.getenv("SMTP_RATE_PER_SECOND", 2))
+SMTP_BURST = int(os.getenv("SMTP_BURST", 5))
+SMTP_TIMEOUT_SECONDS = float(os.getenv("SMTP_TIMEOUT_SECONDS", 30))
+# Reconnect attempts for a message whose connection was dropped before its data was sent
+SMTP_MAX_RECONNECTS = 2
+
+
+class SMTPDeliveryUncertain(smtplib.SMTPException):
+    """The connection failed while the message data was being sent, so the server may have accepted it"""
+
+
+def build_message(sender, to_addr, subj, body, deal_id=None):
+    """(MIME message, envelope recipients) for a plain + HTML follow-up, BCC'd to the deal's Pipedrive inbox"""
+    msg = MIMEMultipart("alternative")
+    msg["Subject"], msg["From"], msg["To"] = subj, sender, to_addr
+    if deal_id:
+        msg["Bcc"] = f"naware+deal{deal_id}@pipedrivemail.com"
+    msg.attach(MIMEText(body, "plain"))
+    msg.attach(MIMEText(body.replace("\n", "<br>"), "html"))
+    return msg, [to_addr] + ([msg["Bcc"]] if deal_id else [])
+
+
+class SMTPBatchSender:
+    """One authenticated STARTTLS connection reused for a whole batch, paced by a token bucket.
+
+    A connection dropped before the message data was sent (servers close
+    idle or long-lived sessions) is re-opened and the message retried. Once
+    DATA has been issued a failure may follow a delivery, so it raises
+    SMTPDeliveryUncertain instead of resending. Use as a context manager so
+    the session is closed with QUIT at the end of the batch.
+    """
+
+    def __init__(self, host, port, username, password, rate=SMTP_RATE_PER_SECOND, burst=SMTP_BURST,
+                 timeout=SMTP_TIMEOUT_SECONDS):
+        self.host = host
+        self.port = int(port)
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.bucket = TokenBucket(rate, burst)
+        self.sent = 0
+        self.connects = 0
+        self.started = None
+        self.finished = None
+        self._server = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def send(self, msg, recipients):
+        """Send one message, reconnecting if the server hung up before DATA; raises on any other SMTP error"""
+        self.bucket.acquire()
+        if self.started is None:
+            self.started = time.perf_counter()
+        for attempt in range(SMTP_MAX_RECONNECTS + 1):
+            try:
+                self._transmit(self._connection(), msg.as_string(), recipients)
+                break
+            except smtplib.SMTPServerDisconnected:
+                self._server = None
+                if attempt == SMTP_MAX_RECONNECTS:
+                    raise
+        self.sent += 1
+
+    @property
+    def messages_per_second(self):
+        if not self.sent or self.started is None:
+            return 0.0
+        return self.sent / max((self.finished or time.perf_counter()) - self.started, 1e-6)
+
+    def close(self):
+        if self.started is not None and self.finished is None:
+            self.finished = time.perf_counter()
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except smtplib.SMTPException:
+                self._server.close()
+            except OSError:
+                pass
+            self._server = None
+
+    def _transmit(self, server, data, recipients):
+        """smtplib's sendmail, split at DATA so failures before it can be told apart from ones during it"""
+        server.ehlo_or_helo_if_needed()
+        code, resp = server.mail(self.username)
+        if code != 250:
+            _reset(server)
+            raise smtplib.SMTPSenderRefused(code, resp, self.username)
+        refused = {}
+        for rcpt in recipients:
+            code, resp = server.rcpt(rcpt)
+            if code not in (250, 251):
+                refused[rcpt] = (code, resp)
+        if len(refused) == len(recipients):
+            _reset(server)
+            raise smtplib.SMTPRecipientsRefused(refused)
+        try:
+            code, resp = server.data(data)
+        except (smtplib.SMTPServerDisconnected, OSError) as e:
+            self._drop()
+            raise SMTPDeliveryUncertain(f"connection lost during DATA: {e}") from e
+        if code != 250:
+            _reset(server)
+            raise smtplib.SMTPDataError(code, resp)
+
+    def _drop(self):
+        if self._server is not None:
+            try:
+                self._server.close()
+            except OSError:
+                pass
+            self._server = None
+
+    def _connection(self):
+        if self._server is None:
+            server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            try:
+                server.starttls(context=ssl.create_default_context())
+                server.login(self.username, self.password)
+            except Exception:
+                server.close()
+                raise
+            self._server = server
+            self.connects += 1
+        return self._server
+
+
+def _reset(server):
+    """RSET after a refusal; a server that hung up instead is reconnected on the next send"""
+    try:
+        server.rset()
+    except smtplib.SMTPServerDisconnected:
+        pass
@@ -0,0 +1,126 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+import numpy as np
+import streamlit as st
+from langchain.embeddings.base import Embeddings
+
+EMBEDDING_CACHE_PATH = os.getenv(
+    "EMBEDDING_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".embedding_cache.sqlite"))
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", 500_000))
+EMBEDDING_CACHE_TTL_DAYS = float(os.getenv("EMBEDDING_CACHE_TTL_DAYS", 90))
+
+
+def chunk_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingStore:
+    """Persistent (model, chunk hash) -> vector store in SQLite with LRU and TTL eviction"""
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH, max_entries=EMBEDDING_CACHE_MAX_ENTRIES,
+                 ttl_days=EMBEDDING_CACHE_TTL_DAYS):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_days * 86400 if ttl_days else None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model TEXT NOT NULL, chunk_hash TEXT NOT NULL, vector BLOB NOT NULL,"
+            " last_used REAL NOT NULL, PRIMARY KEY (model, chunk_hash))")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+        self.evict()
+
+    def get_many(self, model, hashes):
+        """Return {chunk_hash: vector} for the hashes already stored"""
+        found = {}
+        now = time.time()
+        with self._lock:
+            # Stay well under SQLite's bound-parameter limit
+            for start in range(0, len(hashes), 500):
+                batch = hashes[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT chunk_hash, vector FROM embeddings WHERE model = ? AND chunk_hash IN ({placeholders})",
+                    [model, *batch]).fetchall()
+                for h, blob in rows:
+                    found[h] = np.frombuffer(blob, dtype=np.float32).tolist()
+            if found:
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND chunk_hash = ?",
+                    [(now, model, h) for h in found])
+                self._conn.commit()
+            self.hits += len(found)
+            self.misses += len(set(hashes)) - len(found)
+        return found
+
+    def put_many(self, model, items):
+        """Store [(chunk_hash, vector)]"""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, chunk_hash, vector, last_used) VALUES (?, ?, ?, ?)",
+                [(model, h, np.asarray(vector, dtype=np.float32).tobytes(), now) for h, vector in items])
+            self._conn.commit()
+        self.evict()
+
+    def evict(self):
+        """Drop entries past the TTL, then the least recently used beyond max_entries"""
+        with self._lock:
+            if self.ttl_seconds:
+                self._conn.execute("DELETE FROM embeddings WHERE last_used < ?", (time.time() - self.ttl_seconds,))
+            count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE rowid IN ("
+                    " SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)", (count - self.max_entries,))
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+
+class CachedEmbeddings(Embeddings):
+    """Wraps an embeddings model so document chunks already embedded are served from the store"""
+
+    def __init__(self, embeddings, store):
+        self.embeddings = embeddings
+        self.store = store
+        self.model = getattr(embeddings, "model", None) or type(embeddings).__name__
+        self.last_embedded = 0
+
+    def embed_documents(self, texts):
+        hashes = [chunk_hash(text) for text in texts]
+        found = self.store.get_many(self.model, hashes)
+
+        missing = {}
+        for h, text in zip(hashes, texts):
+            if h not in found and h not in missing:
+                missing[h] = text
+        self.last_embedded = len(missing)
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            new_items = list(zip(missing.keys(), vectors))
+            self.store.put_many(self.model, new_items)
+            found.update(new_items)
+        return [found[h] for h in hashes]
+
+    def embed_query(self, text):
+        return self.embeddings.embed_query(text)
+
+
+@st.cache_resource
+def get_embedding_store():
+    """Chunk embedding cache shared by every session and app in this process"""
+    return EmbeddingStore()
@@ -0,0 +1,224 @@
+import os
+import time
+import random
+import queue
+import asyncio
+import threading
+
+from langchain.embeddings.base import Embeddings
+
+# Requests in flight at once
+EMBED_MAX_IN_FLIGHT = int(os.getenv("EMBED_MAX_IN_FLIGHT", 4))
+# Per-request budget; the API caps a request at 300k tokens / 2048 inputs
+EMBED_BATCH_TOKENS = int(os.getenv("EMBED_BATCH_TOKENS", 50_000))
+EMBED_BATCH_MAX_INPUTS = int(os.getenv("EMBED_BATCH_MAX_INPUTS", 256))
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", 8))
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+def token_counter():
+    try:
+        import tiktoken
+        encoding = tiktoken.get_encoding("cl100k_base")
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    except Exception:
+        # Rough but safe for English prose
+        return lambda text: len(text) // 4 + 1
+
+
+def token_batches(texts, count_tokens, max_tokens=EMBED_BATCH_TOKENS, max_inputs=EMBED_BATCH_MAX_INPUTS):
+    """Greedily pack text indices into batches under the token and input budgets"""
+    batches = []
+    current, current_tokens = [], 0
+    for i, text in enumerate(texts):
+        tokens = count_tokens(text)
+        if current and (current_tokens + tokens > max_tokens or len(current) >= max_inputs):
+            batches.append((current, current_tokens))
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += tokens
+    if current:
+        batches.append((current, current_tokens))
+    return batches
+
+
+def _retry_after(error):
+    """Seconds the server asked us to wait, if it said"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        value = headers.get(header)
+        if value:
+            try:
+                return float(value) * scale
+            except ValueError:
+                pass
+    return None
+
+
+def _is_retryable(error):
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    # Connection resets and timeouts carry no status code
+    return type(error).__name__ in ("APIConnectionError", "APITimeoutError", "TimeoutError", "ConnectionError")
+
+
+def openai_batch_fn(embeddings, client=None):
+    """Async batch embedder talking to the OpenAI API directly, with library retries off.
+
+    client is a shared AsyncOpenAI (see clients.get_async_openai_client); without one
+    a client is made per run.
+    """
+    from openai import AsyncOpenAI
+
+    api_key = embeddings.openai_api_key.get_secret_value() if embeddings.openai_api_key else None
+    kwargs = {}
+    if embeddings.dimensions:
+        kwargs["dimensions"] = embeddings.dimensions
+
+    async def embed_batch(client, texts):
+        response = await client.embeddings.create(model=embeddings.model, input=texts, **kwargs)
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+    def make_client():
+        if client is not None:
+            return client
+        # Retries are ours, so 429s honour Retry-After across all in-flight requests
+        return AsyncOpenAI(api_key=api_key, base_url=embeddings.openai_api_base,
+                           organization=embeddings.openai_organization, max_retries=0)
+
+    return make_client, embed_batch
+
+
+def generic_batch_fn(embeddings):
+    """Async batch embedder for any LangChain Embeddings implementation"""
+    async def embed_batch(client, texts):
+        return await embeddings.aembed_documents(texts)
+
+    return (lambda: None), embed_batch
+
+
+class EmbeddingPipeline:
+    """Embeds texts in token-budgeted batches with bounded concurrency and 429-aware backoff"""
+
+    def __init__(self, make_client, embed_batch, max_in_flight=EMBED_MAX_IN_FLIGHT,
+                 max_retries=EMBED_MAX_RETRIES, on_progress=None, close_client=True):
+        self.make_client = make_client
+        self.close_client = close_client
+        self.embed_batch = embed_batch
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.on_progress = on_progress
+        self.count_tokens = token_counter()
+
+    def run(self, texts):
+        """Embed texts, returning vectors in input order.
+
+        The batches run on the shared event loop; progress is reported from the
+        calling thread, so on_progress may update Streamlit elements.
+        """
+        if not texts:
+            return []
+        updates = queue.SimpleQueue()
+        future = asyncio.run_coroutine_threadsafe(self._run(texts, updates), _event_loop())
+        while not future.done() or not updates.empty():
+            try:
+                report = updates.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            self.on_progress(report)
+        return future.result()
+
+    async def _run(self, texts, updates):
+        batches = token_batches(texts, self.count_tokens)
+        vectors = [None] * len(texts)
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        progress = {"done": 0, "total": len(texts), "tokens": 0, "retries": 0, "started": time.perf_counter()}
+        # A 429 on any request pauses every worker until this monotonic time
+        gate = {"resume_at": 0.0}
+        client = self.make_client()
+
+        async def worker(indices, tokens):
+            batch_texts = [texts[i] for i in indices]
+            async with semaphore:
+                for attempt in range(self.max_retries + 1):
+                    wait = gate["resume_at"] - time.monotonic()
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                    try:
+                        result = await self.embed_batch(client, batch_texts)
+                        break
+                    except Exception as e:
+                        if attempt == self.max_retries or not _is_retryable(e):
+                            raise
+                        progress["retries"] += 1
+                        # Full jitter, but never sooner than the server asked
+                        delay = random.uniform(0, min(60.0, 2 ** attempt))
+                        retry_after = _retry_after(e)
+                        if retry_after is not None:
+                            delay = max(delay, retry_after)
+                            gate["resume_at"] = max(gate["resume_at"], time.monotonic() + retry_after)
+                        await asyncio.sleep(delay)
+
+            for i, vector in zip(indices, result):
+                vectors[i] = vector
+            progress["done"] += len(indices)
+            progress["tokens"] += tokens
+            if self.on_progress is not None:
+                updates.put(self._report(progress))
+
+        try:
+            await asyncio.gather(*(worker(indices, tokens) for indices, tokens in batches))
+        finally:
+            close = getattr(client, "close", None) if self.close_client else None
+            if close is not None:
+                await close()
+        return vectors
+
+    def _report(self, progress):
+        elapsed = max(time.perf_counter() - progress["started"], 1e-6)
+        return {
+            "done": progress["done"],
+            "total": progress["total"],
+            "retries": progress["retries"],
+            "chunks_per_sec": progress["done"] / elapsed,
+            "tokens_per_sec": progress["tokens"] / elapsed,
+        }
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _event_loop():
+    """Process-wide event loop on a daemon thread; shared async clients keep their connections on it"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="embedding-pipeline", daemon=True).start()
+        return _loop
+
+
+class PipelinedEmbeddings(Embeddings):
+    """Embeddings whose embed_documents goes through EmbeddingPipeline; queries are unchanged"""
+
+    def __init__(self, embeddings, on_progress=None, max_in_flight=EMBED_MAX_IN_FLIGHT, client=None):
+        self.embeddings = embeddings
+        self.model = getattr(embeddings, "model", None) or type(embeddings).__name__
+        try:
+            from langchain_openai import OpenAIEmbeddings
+            is_openai = isinstance(embeddings, OpenAIEmbeddings)
+        except ImportError:
+            is_openai = False
+        make_client, embed_batch = openai_batch_fn(embeddings, client) if is_openai else generic_batch_fn(embeddings)
+        self.pipeline = EmbeddingPipeline(make_client, embed_batch, max_in_flight=max_in_flight,
+                                          on_progress=on_progress, close_client=client is None)
+
+    def embed_documents(self, texts):
+        return self.pipeline.run(list(texts))
+
+    def embed_query(self, text):
+        return self.embeddings.embed_query(text)
@@ -1,24 +1,37 @@
 import os
 import time
-import ssl
-import smtplib
-import requests
-import re
+import uuid
 import streamlit as st
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from langchain_openai import ChatOpenAI
+from clients import get_chat_model, get_pipedrive_client
+from contact_import import EMAIL_RE, PRODUCTS, prepare_contacts, read_table
+from email_sender import SMTPBatchSender
+from llm_cache import get_llm_cache
+from outbox import account_key, get_outbox
+from pipedrive_client import PipedriveError
 
 from dotenv import load_dotenv
 load_dotenv()
 
+# Preview drafts generated at once, across all sessions
+PREVIEW_MAX_IN_FLIGHT = int(os.getenv("PREVIEW_MAX_IN_FLIGHT", 4))
+# How often the page checks for finished drafts, in seconds
+PREVIEW_REFRESH_SECONDS = float(os.getenv("PREVIEW_REFRESH_SECONDS", 0.5))
+
+
+@st.cache_resource
+def get_preview_pool():
+    """Worker pool drafting follow-up previews in the background"""
+    return ThreadPoolExecutor(max_workers=PREVIEW_MAX_IN_FLIGHT, thread_name_prefix="preview")
+
 
 def render_followup_ui():
     # ——— Defaults & session init —————————————————————————
     DEFAULTS = {
         "contacts": [],
         "previews": {},
+        "preview_jobs": {},  # contact id -> Future of its draft
         "approved": set(),
         "openai_api_key": os.getenv("OPENAI_API_KEY") or st.secrets.get("OPENAI_API_KEY"),
         "pipedrive_domain": os.getenv("PIPEDRIVE_DOMAIN", "Naware") or st.secrets.get("PIPEDRIVE_DOMAIN"),
@@ -39,40 +52,12 @@ def render_followup_ui():
 
     # ——— Helpers —————————————————————————————————————
     def validate_email(e):
-        return bool(re.match(r'^[\w\.-]+@[\w\.-]+\.\w+$', e))
+        return bool(EMAIL_RE.match(e))
 
-    def get_base_url():
-        return f"https://{st.session_state.pipedrive_domain}.pipedrive.com/api/v1"
+    def pipedrive():
+        return get_pipedrive_client(st.session_state.pipedrive_domain, st.session_state.pipedrive_api_token)
 
-    def find_or_create_deal(org):
-        try:
-            resp = requests.get(
-                f"{get_base_url()}/deals/search",
-                params={"api_token": st.session_state.pipedrive_api_token, "term": org},
-            ).json()
-            if resp.get("success") and resp["data"]["items"]:
-                return resp["data"]["items"][0]["item"]["id"]
-            new = requests.post(
-                f"{get_base_url()}/deals",
-                params={"api_token": st.session_state.pipedrive_api_token},
-                json={"title": f"{org} – Demo Follow-Up", "status": "open"},
-            ).json()
-            return new["data"]["id"] if new.get("success") else None
-        except Exception as e:
-            st.error(f"Error with Pipedrive: {e}")
-            return None
-
-    def log_activity(deal_id, subj, body):
-        try:
-            requests.post(
-                f"{get_base_url()}/activities",
-                params={"api_token": st.session_state.pipedrive_api_token},
-                json={"subject": subj, "note": body, "deal_id": deal_id, "type": "email", "done": 1},
-            )
-        except Exception as e:
-            st.error(f"Error logging activity: {e}")
-
-    def gen_email(name, org, date, cta, product):
+    def email_prompt(name, org, date, cta, product):
         date_str = date.strftime("%B %d, %Y")
         prompt = (
             f"SYSTEM: You are a professional sales engineer at Naware, makers of the 'Wipe All Weedrupter,' an innovative steam-based, AI-driven weed control solution.\n\n"
@@ -86,41 +71,36 @@ def render_followup_ui():
             f"  • Sign off warmly as {st.session_state.email_sender_name}, optionally adding a P.S. with a quick tip or resource relevant to their use case.\n\n"
             f"Return just the email body (no subject line) in plain text."
         )
+        return prompt
+
+    def start_preview(ct):
+        """Queue a draft of ct's email on the preview pool; everything session-bound is resolved here"""
+        ct.setdefault("id", uuid.uuid4().hex)
+        prompt = email_prompt(ct["name"], ct["org"], ct["demo_date"], ct["cta"], ct["product"])
+        llm = get_chat_model(st.session_state.selected_model, st.session_state.openai_api_key,
+                             temperature=0.7, max_tokens=350)
+        # Only identical requests are served from the cache: a similar prompt is another contact's email
+        cache = get_llm_cache().scope("followup", st.session_state.get("bypass_llm_cache", False), semantic=False)
+        job = get_preview_pool().submit(cache.call, llm, prompt, lambda: llm.invoke(prompt).content.strip())
+        st.session_state.preview_jobs[ct["id"]] = job
+        return job
 
+    def collect_preview(job):
         try:
-            llm = ChatOpenAI(
-                model_name=st.session_state.selected_model,
-                temperature=0.7,
-                max_tokens=350,
-                api_key=st.session_state.openai_api_key
-            )
-            response = llm.invoke(prompt)  # Use invoke instead of deprecated predict
-            return response.content.strip()  # Access content from the response
+            return job.result()
         except Exception as e:
             st.error(f"Error generating email: {e}")
             return f"Error generating email content: {str(e)}"
 
-    def send_email(to_addr, subj, body, deal_id=None):
-        try:
-            msg = MIMEMultipart("alternative")
-            msg["Subject"], msg["From"], msg["To"] = subj, st.session_state.email_username, to_addr
-            if deal_id:
-                msg["Bcc"] = f"naware+deal{deal_id}@pipedrivemail.com"
-            msg.attach(MIMEText(body, "plain"))
-            msg.attach(MIMEText(body.replace("\n", "<br>"), "html"))
-            ctx = ssl.create_default_context()
-            with smtplib.SMTP(st.session_state.smtp_server, int(st.session_state.smtp_port)) as srv:
-                srv.starttls(context=ctx)
-                srv.login(st.session_state.email_username, st.session_state.email_password)
-                srv.sendmail(
-                    st.session_state.email_username,
-                    [to_addr] + ([msg["Bcc"]] if deal_id else []),
-                    msg.as_string()
-                )
-            return True
-        except Exception as e:
-            st.error(f"Error sending email: {e}")
-            return False
+    def account_outbox():
+        """This session's sending account's outbox; other accounts' jobs are neither shown nor touched"""
+        return get_outbox(account_key(st.session_state.email_username, st.session_state.pipedrive_domain))
+
+    def start_outbox():
+        """Make sure this account's outbox worker is draining, with this session's SMTP and CRM settings"""
+        smtp = (st.session_state.smtp_server, st.session_state.smtp_port,
+                st.session_state.email_username, st.session_state.email_password)
+        account_outbox().ensure_worker(lambda: SMTPBatchSender(*smtp), pipedrive())
 
     # ——— Sidebar settings —————————————————————————————
     with st.sidebar:
@@ -136,6 +116,17 @@ def render_followup_ui():
         st.session_state.pipedrive_domain = st.text_input("Domain", st.session_state.pipedrive_domain)
         st.session_state.pipedrive_api_token = st.text_input(
             "API Token", st.session_state.pipedrive_api_token, type="password")
+        mirror = pipedrive().mirror
+        if st.button("🔄 Sync CRM mirror", help="Pull deals and organizations changed since the last sync"):
+            try:
+                st.caption(f"Pulled {mirror.sync()} changed records")
+            except PipedriveError as e:
+                st.error(f"Error syncing Pipedrive: {e}")
+        mirror_stats = mirror.stats()
+        if mirror_stats["last_sync"]:
+            last_sync = datetime.fromtimestamp(mirror_stats["last_sync"]).strftime('%H:%M')
+            st.caption(f"🗂️ {mirror_stats['organizations']} orgs, {mirror_stats['deals']} deals mirrored "
+                       f"(synced {last_sync})")
 
         st.subheader("Email SMTP")
         st.session_state.smtp_server = st.text_input("SMTP Server", st.session_state.smtp_server)
@@ -146,6 +137,14 @@ def render_followup_ui():
             st.error("🚨 SMTP Port must be a number")
         st.session_state.email_sender_name = st.text_input("Sender Name", st.session_state.email_sender_name)
 
+        st.subheader("Response Cache")
+        st.checkbox("Bypass response cache", False, key="bypass_llm_cache",
+                    help="Always call the model; fresh responses still replace cached ones")
+        llm_cache_stats = get_llm_cache().stats("followup")
+        if llm_cache_stats['hits'] or llm_cache_stats['misses']:
+            st.caption(f"💾 {llm_cache_stats['hit_rate']:.0%} hit rate "
+                       f"({llm_cache_stats['hits']} hits, {llm_cache_stats['misses']} misses)")
+
     # ——— Main page ————————————————————————————————
     st.title("📧 Demo Follow-Up Email Generator")
 
@@ -157,24 +156,58 @@ def render_followup_ui():
         o = st.text_input("Organization")
         d = st.date_input("Demo Date", datetime.today())
         cta = st.text_input("CTA Link")
-        prod = st.selectbox("Product Demo'd", ["Wipe All", "AI-driven solution"])
+        prod = st.selectbox("Product Demo'd", PRODUCTS)
         if st.form_submit_button("Add contact"):
             if not (n and validate_email(e) and o and cta):
                 st.error("Please fill name, valid email, org & CTA.")
             else:
-                st.session_state.contacts.append({
-                    "name": n, "email": e, "org": o,
+                contact = {
+                    "id": uuid.uuid4().hex, "name": n, "email": e, "org": o,
                     "demo_date": d, "cta": cta, "product": prod
-                })
+                }
+                st.session_state.contacts.append(contact)
+                # Start drafting right away rather than on the next render
+                start_preview(contact)
+
+    with st.expander("📥 Bulk import contacts (CSV / XLSX)"):
+        st.caption("Columns: Name, Email, Organization, and optionally Demo Date, CTA Link, Product. "
+                   "Blank optional cells take the defaults below.")
+        with st.form("import_contacts", clear_on_submit=True):
+            upload = st.file_uploader("Contacts file", type=["csv", "xlsx"])
+            import_date = st.date_input("Default demo date", datetime.today())
+            import_cta = st.text_input("Default CTA link")
+            import_product = st.selectbox("Default product", PRODUCTS)
+            if st.form_submit_button("Import contacts") and upload is not None:
+                try:
+                    imported, import_errors = prepare_contacts(
+                        read_table(upload.getvalue(), upload.name), import_date, import_cta, import_product,
+                        existing_emails=[ct["email"] for ct in st.session_state.contacts])
+                except Exception as e:
+                    st.error(f"Could not read {upload.name}: {e}")
+                else:
+                    # Drafts start in the preview loop below
+                    st.session_state.contacts.extend(imported)
+                    st.success(f"Imported {len(imported)} contact(s)")
+                    if len(import_errors):
+                        st.warning(f"Skipped {len(import_errors)} row(s)")
+                        st.dataframe(import_errors, hide_index=True)
 
     # 2) Preview & approve
     st.markdown("### 👀 Preview & Edit Emails")
+    drafting_status = st.empty()
+    drafting = []
     for idx, ct in enumerate(st.session_state.contacts):
         subj = f"Thank you, {ct['org']} – Next steps"
         if idx not in st.session_state.previews:
-            st.session_state.previews[idx] = gen_email(
-                ct["name"], ct["org"], ct["demo_date"], ct["cta"], ct["product"]
-            )
+            job = st.session_state.preview_jobs.get(ct.get("id")) or start_preview(ct)
+            if not job.done():
+                drafting.append(job)
+                st.text_area(f"{ct['name']} @ {ct['org']} — Edit your email:", "", height=200, disabled=True,
+                             placeholder="✍️ Drafting…", key=f"drafting_{ct['id']}")
+                st.write("---")
+                continue
+            del st.session_state.preview_jobs[ct["id"]]
+            st.session_state.previews[idx] = collect_preview(job)
 
         body = st.text_area(
             f"{ct['name']} @ {ct['org']} — Edit your email:",
@@ -184,53 +217,97 @@ def render_followup_ui():
         )
         st.session_state.previews[idx] = body
 
+        # Similar names in the CRM may be another customer, so they are only used once picked here
+        if "crm_candidates" not in ct:
+            mirror = pipedrive().mirror
+            mirror.maybe_sync()
+            candidates = mirror.candidates(ct["org"])
+            # A mirror that has never synced knows no names yet: look again on the next rerun
+            if candidates or mirror.stats()["last_sync"]:
+                ct["crm_candidates"] = candidates
+        if ct.get("crm_candidates"):
+            choice = st.selectbox(
+                f"Pipedrive deal for {ct['org']}", [None] + ct["crm_candidates"], key=f"deal_{ct['id']}",
+                format_func=lambda c: f"Look up or create “{ct['org']}”" if c is None
+                else f"{c['name']} (deal {c['deal_id']}, {c['score']:.0%} similar)",
+                help="These deals have similar names. Pick one only if it is the same customer.")
+            ct["deal_id"] = choice["deal_id"] if choice else None
+
         if st.checkbox("Approve this email", key=f"ok_{idx}"):
             st.session_state.approved.add(idx)
         st.write("---")
 
-    # 3) Send & log
+    # 3) Send & log, through the durable outbox
+    outbox = account_outbox()
     approved = sorted(st.session_state.approved)
     if approved:
         if st.button(f"✉️ Send & Log {len(approved)} emails"):
-            success_count = 0
             for i in approved:
                 ct = st.session_state.contacts[i]
-                subj = f"Thank you, {ct['org']} – Next steps"
-                body = st.session_state.previews[i]
-
-                # find or create deal
-                deal_id = find_or_create_deal(ct["org"])
-                # send email
-                if send_email(ct["email"], subj, body, deal_id=deal_id):
-                    success_count += 1
-                    # log in Pipedrive
-                    if deal_id:
-                        log_activity(deal_id, subj, body)
-                time.sleep(0.5)
-
-            if success_count > 0:
-                st.success(f"✅ Sent & logged {success_count} emails")
-
-                # Remove only the sent contacts and their associated data
-                remaining_contacts = []
-                remaining_previews = {}
-
-                for idx, contact in enumerate(st.session_state.contacts):
-                    if idx not in approved:
-                        new_idx = len(remaining_contacts)
-                        remaining_contacts.append(contact)
-                        if idx in st.session_state.previews:
-                            remaining_previews[new_idx] = st.session_state.previews[idx]
-
-                st.session_state.contacts = remaining_contacts
-                st.session_state.previews = remaining_previews
-                st.session_state.approved.clear()
-
-                # Force a rerun to refresh the UI
-                time.sleep(2)
-                st.rerun()
-            else:
-                st.error("Failed to send any emails. Please check your configuration.")
+                outbox.enqueue(st.session_state.email_username, ct["email"], ct["org"],
+                               f"Thank you, {ct['org']} – Next steps", st.session_state.previews[i],
+                               deal_id=ct.get("deal_id"))
+            start_outbox()
+
+            # Queued emails belong to the outbox now; drop their contacts from the editing list
+            remaining_contacts = []
+            remaining_previews = {}
+
+            for idx, contact in enumerate(st.session_state.contacts):
+                if idx not in approved:
+                    new_idx = len(remaining_contacts)
+                    remaining_contacts.append(contact)
+                    if idx in st.session_state.previews:
+                        remaining_previews[new_idx] = st.session_state.previews[idx]
+
+            st.session_state.contacts = remaining_contacts
+            st.session_state.previews = remaining_previews
+            st.session_state.approved.clear()
+            st.rerun()
 
     else:
         st.info("Check ✔️ boxes above to approve emails, then click Send & Log.")
+
+    # 4) Outbox status; jobs left over from a restart are picked up again here
+    outbox_jobs = outbox.jobs()
+    outbox_status = st.empty()
+    if outbox_jobs:
+        st.markdown("### 📤 Outbox")
+        counts = outbox.counts()
+        if outbox.active():
+            start_outbox()
+        st.caption(" · ".join(f"{status}: {count}" for status, count in sorted(counts.items())))
+        if outbox.last_drain and outbox.last_drain["sent"]:
+            run = outbox.last_drain
+            st.caption(f"Last run: {run['sent']} sent, {run['logged']} logged in {run['seconds']:.1f}s "
+                       f"({run['sent'] / max(run['seconds'], 1e-6):.1f} msg/s)")
+        st.dataframe(outbox_jobs, hide_index=True, column_order=[
+            "to_addr", "org", "status", "deal_id", "send_attempts", "log_attempts", "last_error"])
+        if counts.get("uncertain"):
+            st.warning("Some emails were interrupted mid-send and may already have gone out. "
+                       "Check your Sent folder before resending them.")
+        retry_col, resend_col = st.columns(2)
+        if counts.get("failed") or counts.get("log_failed"):
+            if retry_col.button("🔁 Retry failed"):
+                outbox.requeue(("failed", "log_failed"))
+                start_outbox()
+                st.rerun()
+        if counts.get("uncertain"):
+            if resend_col.button("⚠️ Resend uncertain"):
+                outbox.requeue(("uncertain",))
+                start_outbox()
+                st.rerun()
+
+    # Rerun as soon as a draft finishes; the status update lets widget interactions interrupt the wait
+    # and likewise whenever an outbox job changes status
+    outbox_version = outbox.version
+    while drafting or outbox.busy():
+        if drafting:
+            drafting_status.caption(f"✍️ Drafting {len(drafting)} email(s) in the background…")
+            done, drafting = wait(drafting, timeout=PREVIEW_REFRESH_SECONDS, return_when=FIRST_COMPLETED)
+        else:
+            outbox_status.caption(f"📤 Delivering {outbox.busy()} email(s)…")
+            time.sleep(PREVIEW_REFRESH_SECONDS)
+            done = False
+        if done or outbox.version != outbox_version:
+            st.rerun()
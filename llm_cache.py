@@ -0,0 +1,184 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import defaultdict
+
+import numpy as np
+import streamlit as st
+
+from local_retrieval import HashingEmbeddings
+
+LLM_CACHE_PATH = os.getenv(
+    "LLM_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".llm_cache.sqlite"))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", 20_000))
+LLM_CACHE_TTL_DAYS = float(os.getenv("LLM_CACHE_TTL_DAYS", 30))
+# Cosine similarity above which a near-identical prompt is served from cache; 0 disables that tier
+LLM_CACHE_SEMANTIC_THRESHOLD = float(os.getenv("LLM_CACHE_SEMANTIC_THRESHOLD", 0))
+# Most recent same-context entries compared against on a semantic lookup
+LLM_CACHE_SEMANTIC_CANDIDATES = 500
+
+
+def context_hash(docs):
+    """Hash of the retrieved documents a prompt was answered with"""
+    digest = hashlib.sha256()
+    for doc in docs:
+        digest.update(str(doc.metadata.get("source", "")).encode('utf-8'))
+        digest.update(b"\0")
+        digest.update(doc.page_content.encode('utf-8'))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def llm_identity(llm):
+    """(model, temperature) of a chat model, as used in cache keys"""
+    model = getattr(llm, "model_name", None) or getattr(llm, "model", None) or type(llm).__name__
+    return model, getattr(llm, "temperature", None)
+
+
+class LLMResponseCache:
+    """Persistent LLM response cache in SQLite keyed by model, temperature, prompt and context.
+
+    An optional second tier serves a prompt whose embedding is within
+    semantic_threshold of a cached one with the same model, temperature and context.
+    It only applies to context-grounded generations in scopes that allow it:
+    prompts that differ only in a name or a date must never share an answer.
+    """
+
+    def __init__(self, path=LLM_CACHE_PATH, max_entries=LLM_CACHE_MAX_ENTRIES, ttl_days=LLM_CACHE_TTL_DAYS,
+                 semantic_threshold=LLM_CACHE_SEMANTIC_THRESHOLD):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_days * 86400 if ttl_days else None
+        self.semantic_threshold = semantic_threshold
+        self.embeddings = HashingEmbeddings() if semantic_threshold else None
+        self.counters = defaultdict(lambda: {"hits": 0, "semantic_hits": 0, "misses": 0})
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, model TEXT NOT NULL, temperature REAL, context_hash TEXT NOT NULL,"
+            " prompt_vector BLOB, response TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_context ON responses (model, context_hash)")
+        self._conn.commit()
+        self.evict()
+
+    @staticmethod
+    def key(model, temperature, prompt, context=""):
+        return hashlib.sha256(f"{model}\0{temperature}\0{context}\0{prompt}".encode('utf-8')).hexdigest()
+
+    def get(self, namespace, model, temperature, prompt, context="", semantic=True):
+        """Cached response text, or None; counted towards namespace's hit rate"""
+        key = self.key(model, temperature, prompt, context)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and self._fresh(row[1], now):
+                self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+                self._conn.commit()
+                self.counters[namespace]["hits"] += 1
+                return row[0]
+
+        response = None
+        if self.embeddings is not None and semantic and context:
+            response = self._semantic_get(model, temperature, prompt, context, now)
+        with self._lock:
+            self.counters[namespace]["semantic_hits" if response is not None else "misses"] += 1
+        return response
+
+    def put(self, model, temperature, prompt, response, context="", semantic=True):
+        vector = None
+        # Only entries that may be served by similarity get a vector to be found by
+        if self.embeddings is not None and semantic and context:
+            vector = np.asarray(self.embeddings.embed_query(prompt), dtype=np.float32).tobytes()
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses"
+                " (key, model, temperature, context_hash, prompt_vector, response, created, last_used)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (self.key(model, temperature, prompt, context), model, temperature, context, vector, response,
+                 now, now))
+            self._conn.commit()
+        self.evict()
+
+    def evict(self):
+        """Drop entries past the TTL, then the least recently used beyond max_entries"""
+        with self._lock:
+            if self.ttl_seconds:
+                self._conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl_seconds,))
+            count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM responses WHERE rowid IN ("
+                    " SELECT rowid FROM responses ORDER BY last_used LIMIT ?)", (count - self.max_entries,))
+            self._conn.commit()
+
+    def stats(self, namespace):
+        with self._lock:
+            counters = dict(self.counters[namespace])
+        lookups = counters["hits"] + counters["semantic_hits"] + counters["misses"]
+        counters["hit_rate"] = (counters["hits"] + counters["semantic_hits"]) / lookups if lookups else 0.0
+        return counters
+
+    def scope(self, namespace, bypass=False, semantic=True):
+        return CacheScope(self, namespace, bypass, semantic)
+
+    # ——— internals ————————————————————————————————————
+    def _fresh(self, created, now):
+        return not self.ttl_seconds or created >= now - self.ttl_seconds
+
+    def _semantic_get(self, model, temperature, prompt, context, now):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, prompt_vector, response, created FROM responses"
+                " WHERE model = ? AND temperature IS ? AND context_hash = ? AND prompt_vector IS NOT NULL"
+                " ORDER BY last_used DESC LIMIT ?",
+                (model, temperature, context, LLM_CACHE_SEMANTIC_CANDIDATES)).fetchall()
+        rows = [row for row in rows if self._fresh(row[3], now)]
+        if not rows:
+            return None
+        query = np.asarray(self.embeddings.embed_query(prompt), dtype=np.float32)
+        # Hashing embeddings are L2-normalised, so the dot product is the cosine
+        similarities = np.stack([np.frombuffer(row[1], dtype=np.float32) for row in rows]) @ query
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.semantic_threshold:
+            return None
+        with self._lock:
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, rows[best][0]))
+            self._conn.commit()
+        return rows[best][2]
+
+
+class CacheScope:
+    """One app's view of the shared cache; bypass skips lookups but still stores fresh responses.
+
+    semantic=False keeps the scope exact-match only, for personalized prompts.
+    """
+
+    def __init__(self, cache, namespace, bypass=False, semantic=True):
+        self.cache = cache
+        self.namespace = namespace
+        self.bypass = bypass
+        self.semantic = semantic
+
+    def call(self, llm, prompt, generate, context=""):
+        """Cached text for (llm, prompt, context), or generate() and store it"""
+        model, temperature = llm_identity(llm)
+        if not self.bypass:
+            cached = self.cache.get(self.namespace, model, temperature, prompt, context, self.semantic)
+            if cached is not None:
+                return cached
+        response = generate()
+        self.cache.put(model, temperature, prompt, response, context, self.semantic)
+        return response
+
+
+@st.cache_resource
+def get_llm_cache():
+    """LLM response cache shared by every session and app in this process"""
+    return LLMResponseCache()
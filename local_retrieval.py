@@ -0,0 +1,168 @@
+import os
+import re
+import math
+import heapq
+import zlib
+from collections import Counter, defaultdict
+from functools import lru_cache
+from typing import Any, List, Optional
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+from langchain.schema import BaseRetriever
+
+LOCAL_EMBEDDING_DIM = int(os.getenv("LOCAL_EMBEDDING_DIM", 768))
+# Optional sentence-transformers model name; needs the package and a cached model
+LOCAL_EMBEDDING_MODEL = os.getenv("LOCAL_EMBEDDING_MODEL")
+
+TOKEN_RE = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the this to was were will with".split())
+
+
+def tokenize(text):
+    return [t for t in TOKEN_RE.findall(text.lower()) if t not in STOPWORDS]
+
+
+class HashingEmbeddings(Embeddings):
+    """CPU-only embedder: hashed unigrams + bigrams, sublinear TF, L2-normalised.
+
+    No model download and no network, so indexing works offline at thousands
+    of chunks per second. Quality is lexical, not semantic.
+    """
+
+    def __init__(self, dim=LOCAL_EMBEDDING_DIM):
+        self.dim = dim
+        self.model = f"local-hashing-{dim}"
+
+    def _bucket(self, feature):
+        # crc32 is stable across processes (unlike hash()), so saved indexes stay valid
+        value = zlib.crc32(feature.encode('utf-8'))
+        # Low bit picks the sign so collisions tend to cancel rather than pile up
+        return (value >> 1) % self.dim, 1.0 if value & 1 else -1.0
+
+    def _embed(self, text):
+        tokens = tokenize(text)
+        features = Counter(tokens)
+        features.update(f"{a} {b}" for a, b in zip(tokens, tokens[1:]))
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature, count in features.items():
+            bucket, sign = self._bucket(feature)
+            vector[bucket] += sign * (1.0 + math.log(count))
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector.tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+@lru_cache(maxsize=1)
+def get_local_embeddings():
+    """sentence-transformers when configured and installed, else the hashing embedder"""
+    if LOCAL_EMBEDDING_MODEL:
+        try:
+            from langchain_community.embeddings import HuggingFaceEmbeddings
+            embeddings = HuggingFaceEmbeddings(model_name=LOCAL_EMBEDDING_MODEL,
+                                               model_kwargs={"device": "cpu"})
+            embeddings.model = LOCAL_EMBEDDING_MODEL
+            return embeddings
+        except Exception:
+            pass
+    return HashingEmbeddings()
+
+
+class BM25Index:
+    """Okapi BM25 inverted index supporting incremental add/remove by chunk id"""
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(dict)  # term -> {chunk_id: term frequency}
+        self.doc_lengths = {}
+        self.docs = {}
+        self._total_length = 0
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, chunk_id, doc):
+        if chunk_id in self.docs:
+            self.remove(chunk_id)
+        terms = Counter(tokenize(doc.page_content))
+        for term, tf in terms.items():
+            self.postings[term][chunk_id] = tf
+        length = sum(terms.values())
+        self.doc_lengths[chunk_id] = length
+        self.docs[chunk_id] = doc
+        self._total_length += length
+
+    def remove(self, chunk_id):
+        doc = self.docs.pop(chunk_id, None)
+        if doc is None:
+            return
+        for term in set(tokenize(doc.page_content)):
+            postings = self.postings.get(term)
+            if postings is not None:
+                postings.pop(chunk_id, None)
+                if not postings:
+                    del self.postings[term]
+        self._total_length -= self.doc_lengths.pop(chunk_id)
+
+    def search(self, query, k=4, allowed=None):
+        """Top-k (chunk_id, score), optionally only among chunk ids in allowed"""
+        n = len(self.docs)
+        if not n:
+            return []
+        avg_length = self._total_length / n or 1.0
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for chunk_id, tf in postings.items():
+                if allowed is not None and chunk_id not in allowed:
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[chunk_id] / avg_length)
+                scores[chunk_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+
+class BM25Retriever(BaseRetriever):
+    """Lexical retriever over a BM25Index, optionally limited to some source files"""
+
+    index: Any
+    sources: Optional[List[str]] = None
+    k: int = 4
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        allowed = None
+        if self.sources:
+            wanted = set(self.sources)
+            allowed = {chunk_id for chunk_id, doc in self.index.docs.items()
+                       if doc.metadata.get("source") in wanted}
+        return [self.index.docs[chunk_id] for chunk_id, _ in self.index.search(query, self.k, allowed)]
+
+
+class HybridRetriever(BaseRetriever):
+    """Reciprocal-rank fusion of several retrievers (e.g. BM25 + vectors)"""
+
+    retrievers: List[Any]
+    k: int = 4
+    rrf_k: int = 60
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        scores = defaultdict(float)
+        docs = {}
+        for retriever in self.retrievers:
+            for rank, doc in enumerate(retriever.invoke(query)):
+                key = (doc.metadata.get("source"), doc.page_content)
+                scores[key] += 1.0 / (self.rrf_k + rank + 1)
+                docs.setdefault(key, doc)
+        ranked = sorted(scores, key=scores.get, reverse=True)
+        return [docs[key] for key in ranked[:self.k]]
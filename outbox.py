@@ -0,0 +1,330 @@
+import os
+import time
+import random
+import sqlite3
+import hashlib
+import smtplib
+import logging
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from email.utils import make_msgid
+
+import streamlit as st
+
+from email_sender import SMTPDeliveryUncertain, build_message
+from pipedrive_client import PipedriveError
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_PATH = os.getenv(
+    "OUTBOX_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".outbox.sqlite"))
+# (max attempts, first retry delay in seconds) per stage; delays double per attempt
+SEND_RETRY = (int(os.getenv("OUTBOX_SEND_MAX_ATTEMPTS", 3)), float(os.getenv("OUTBOX_SEND_RETRY_SECONDS", 30)))
+LOG_RETRY = (int(os.getenv("OUTBOX_LOG_MAX_ATTEMPTS", 6)), float(os.getenv("OUTBOX_LOG_RETRY_SECONDS", 10)))
+RETRY_MAX_SECONDS = 15 * 60
+# Threads making Pipedrive calls (deal lookups ahead of the sender, activity logging behind it)
+OUTBOX_CRM_WORKERS = int(os.getenv("OUTBOX_CRM_WORKERS", 4))
+# Queued jobs whose deal lookups run ahead of the one being sent
+OUTBOX_LOOKAHEAD = int(os.getenv("OUTBOX_LOOKAHEAD", 8))
+
+# queued -> sending -> sent -> logging -> logged. A job found "sending" after a
+# restart, or whose connection dropped during DATA, may or may not have gone out,
+# so it becomes "uncertain" instead of being resent.
+ACTIVE_STATUSES = ("queued", "sending", "sent", "logging")
+FINAL_STATUSES = ("logged", "failed", "log_failed", "uncertain")
+
+
+def account_key(smtp_username, pipedrive_domain):
+    """Identity of a sending account: jobs are only sent through, and logged into, the account that queued them"""
+    return f"{smtp_username.strip().lower()}|{pipedrive_domain.strip().lower()}"
+
+
+def idempotency_key(account, to_addr, subject, body):
+    """The same email to the same person is one job, however many times Send is clicked"""
+    return hashlib.sha256(
+        f"{account}\0{to_addr.strip().lower()}\0{subject}\0{body}".encode('utf-8')).hexdigest()
+
+
+class Outbox:
+    """Durable SQLite queue of one account's approved follow-ups.
+
+    Accounts share the database file but every query is scoped to
+    self.account, so a worker never sends or logs another account's jobs.
+    Each job goes through an SMTP send stage and then a CRM log stage, each
+    retried with its own backoff policy, so a restart mid-batch neither
+    loses nor double-sends mail. drain() pipelines the stages until nothing
+    is due; ensure_worker() keeps one draining thread per process.
+    """
+
+    def __init__(self, account, path=OUTBOX_PATH):
+        self.account = account
+        self.path = path
+        self.version = 0  # bumped on every job change, for cheap UI polling
+        self.last_drain = None  # {"sent", "logged", "seconds"} of the latest drain
+        self._lock = threading.Lock()
+        self._worker = None
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " key TEXT PRIMARY KEY, account TEXT, from_addr TEXT NOT NULL, to_addr TEXT NOT NULL, org TEXT NOT NULL,"
+            " subject TEXT NOT NULL, body TEXT NOT NULL, status TEXT NOT NULL, deal_id INTEGER, message_id TEXT,"
+            " send_attempts INTEGER NOT NULL DEFAULT 0, log_attempts INTEGER NOT NULL DEFAULT 0, last_error TEXT,"
+            " next_attempt REAL NOT NULL, created REAL NOT NULL, updated REAL NOT NULL)")
+        if "account" not in {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}:
+            # Jobs queued before accounts were recorded keep a NULL account and are never drained
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN account TEXT")
+        self._conn.execute("DROP INDEX IF EXISTS jobs_due")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_account_due ON jobs (account, status, next_attempt)")
+        # Nothing of this account's is in flight when its outbox is opened
+        self._conn.execute("UPDATE jobs SET status = 'uncertain', last_error = 'interrupted while sending'"
+                           " WHERE account = ? AND status = 'sending'", (account,))
+        self._conn.execute("UPDATE jobs SET status = 'sent' WHERE account = ? AND status = 'logging'", (account,))
+        self._conn.commit()
+
+    def enqueue(self, from_addr, to_addr, org, subject, body, deal_id=None):
+        """Queue one email; returns its key. Re-enqueueing an existing job leaves it as it is.
+
+        deal_id is a deal confirmed by the user; without one the org's deal is looked up when sending.
+        """
+        key = idempotency_key(self.account, to_addr, subject, body)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO jobs (key, account, from_addr, to_addr, org, subject, body, status, deal_id,"
+                " next_attempt, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, 'queued', ?, ?, ?, ?)",
+                (key, self.account, from_addr, to_addr, org, subject, body, deal_id, now, now, now))
+            self._conn.commit()
+            self.version += 1
+        return key
+
+    def requeue(self, statuses=("failed",)):
+        """Give jobs in the given final statuses a fresh set of attempts; returns how many"""
+        stage = {"failed": "queued", "uncertain": "queued", "log_failed": "sent"}
+        count = 0
+        with self._lock:
+            for status in statuses:
+                count += self._conn.execute(
+                    "UPDATE jobs SET status = ?, send_attempts = CASE WHEN ? = 'queued' THEN 0 ELSE send_attempts END,"
+                    " log_attempts = 0, next_attempt = ?, updated = ? WHERE account = ? AND status = ?",
+                    (stage[status], stage[status], time.time(), time.time(), self.account, status)).rowcount
+            self._conn.commit()
+            self.version += 1
+        return count
+
+    def jobs(self, limit=50):
+        """Most recently updated jobs, newest first, as dicts"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT key, to_addr, org, status, deal_id, send_attempts, log_attempts, last_error, updated"
+                " FROM jobs WHERE account = ? ORDER BY updated DESC LIMIT ?", (self.account, limit))
+            columns = [c[0] for c in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def counts(self):
+        with self._lock:
+            return dict(self._conn.execute("SELECT status, COUNT(*) FROM jobs WHERE account = ? GROUP BY status",
+                                           (self.account,)).fetchall())
+
+    def active(self):
+        with self._lock:
+            return self._conn.execute(
+                f"SELECT COUNT(*) FROM jobs WHERE account = ? AND status IN ({','.join('?' * len(ACTIVE_STATUSES))})",
+                (self.account, *ACTIVE_STATUSES)).fetchone()[0]
+
+    def busy(self, horizon=5):
+        """Jobs in flight or due within horizon seconds; what a page showing progress should wait for"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE account = ? AND (status IN ('sending', 'logging')"
+                " OR (status IN ('queued', 'sent') AND next_attempt <= ?))",
+                (self.account, time.time() + horizon)).fetchone()[0]
+
+    # ——— Worker ————————————————————————————————————————
+    def ensure_worker(self, open_sender, crm):
+        """Start a draining thread unless one is running; returns True if one was started.
+
+        open_sender() returns a fresh SMTPBatchSender and crm is a PipedriveClient,
+        both for self.account.
+        """
+        with self._lock:
+            if self._worker is not None and self._worker.is_alive():
+                return False
+            self._worker = threading.Thread(target=self.drain, args=(open_sender, crm), daemon=True,
+                                            name="outbox")
+            self._worker.start()
+            return True
+
+    def drain(self, open_sender, crm):
+        """Run due jobs until none are left, sleeping through retry delays.
+
+        This thread sends over one SMTP session, paced by the sender's token
+        bucket, while a CRM pool resolves deals for the jobs queued behind
+        the current one and logs activities for sent ones; Pipedrive calls
+        are paced by the client's own bucket.
+        """
+        sender = None
+        lookups = {}  # job key -> Future of its deal id
+        logging_jobs = set()
+        stats = {"sent": 0, "logged": 0, "started": time.perf_counter()}
+        with ThreadPoolExecutor(max_workers=OUTBOX_CRM_WORKERS, thread_name_prefix="outbox-crm") as crm_pool:
+            try:
+                while True:
+                    for job in self._upcoming(OUTBOX_LOOKAHEAD):
+                        if job["deal_id"] is None and job["key"] not in lookups:
+                            lookups[job["key"]] = crm_pool.submit(crm.find_or_create_deal, job["org"])
+                    while (job := self._claim("sent")) is not None:
+                        logging_jobs.add(crm_pool.submit(self._run, self._log, job, crm, stats))
+                    logging_jobs = {future for future in logging_jobs if not future.done()}
+
+                    job = self._claim("queued")
+                    if job is not None:
+                        if sender is None:
+                            try:
+                                sender = open_sender()
+                            except Exception as e:
+                                # Bad settings (e.g. a non-numeric port): nothing went out, and retrying won't help
+                                self._retry(job, "send_attempts", SEND_RETRY, "queued", "failed", e, permanent=True)
+                                continue
+                        self._run(self._send, job, sender, crm, stats, lookups.pop(job["key"], None))
+                        continue
+
+                    due_in = self._next_due()
+                    if due_in is None and not logging_jobs:
+                        return
+                    if sender is not None and (due_in is None or due_in > 1):
+                        # Don't hold an idle SMTP session through a retry delay
+                        _close_sender(sender)
+                        sender = None
+                    timeout = 5 if due_in is None else min(max(due_in, 0.05), 5)
+                    if logging_jobs:
+                        wait(logging_jobs, timeout=timeout, return_when=FIRST_COMPLETED)
+                    else:
+                        time.sleep(timeout)
+            except Exception:
+                logger.exception("Outbox worker stopped")
+            finally:
+                if sender is not None:
+                    _close_sender(sender)
+                self.last_drain = {"sent": stats["sent"], "logged": stats["logged"],
+                                   "seconds": time.perf_counter() - stats["started"]}
+
+    def _run(self, stage, job, *args):
+        try:
+            stage(job, *args)
+        except Exception as e:
+            # Unexpected, so don't guess: park the job where a person will look at it
+            logger.exception("Outbox job for %s failed unexpectedly", job["to_addr"])
+            self._update(job["key"], status="uncertain" if job["status"] == "sending" else "log_failed",
+                         last_error=str(e)[:500])
+
+    # ——— Stages ————————————————————————————————————————
+    def _send(self, job, sender, crm, stats, lookup=None):
+        deal_id = job["deal_id"]
+        if deal_id is None:
+            try:
+                deal_id = lookup.result() if lookup is not None else crm.find_or_create_deal(job["org"])
+            except Exception as e:
+                # Mail still goes out; the log stage resolves the deal again
+                logger.warning("Deal lookup for %s failed: %s", job["org"], e)
+        message_id = job["message_id"] or make_msgid(idstring=job["key"][:16])
+        msg, recipients = build_message(job["from_addr"], job["to_addr"], job["subject"], job["body"], deal_id)
+        msg["Message-ID"] = message_id
+        try:
+            sender.send(msg, recipients)
+        except SMTPDeliveryUncertain as e:
+            # The server may have accepted it: leave the decision to resend to a person
+            logger.warning("Outbox send to %s may or may not have gone out: %s", job["to_addr"], e)
+            self._update(job["key"], status="uncertain", deal_id=deal_id, message_id=message_id,
+                         send_attempts=job["send_attempts"] + 1, last_error=str(e)[:500])
+            return
+        except (smtplib.SMTPException, OSError) as e:
+            permanent = isinstance(e, smtplib.SMTPRecipientsRefused) or (
+                isinstance(e, smtplib.SMTPResponseException) and 500 <= e.smtp_code < 600)
+            self._retry(job, "send_attempts", SEND_RETRY, "queued", "failed", e, permanent,
+                        deal_id=deal_id, message_id=message_id)
+            return
+        self._update(job["key"], status="sent", deal_id=deal_id, message_id=message_id,
+                     send_attempts=job["send_attempts"] + 1, last_error=None, next_attempt=time.time())
+        stats["sent"] += 1
+
+    def _log(self, job, crm, stats):
+        try:
+            deal_id = job["deal_id"] if job["deal_id"] is not None else crm.find_or_create_deal(job["org"])
+            crm.log_activity(deal_id, job["subject"], job["body"])
+        except PipedriveError as e:
+            self._retry(job, "log_attempts", LOG_RETRY, "sent", "log_failed", e)
+            return
+        self._update(job["key"], status="logged", deal_id=deal_id, log_attempts=job["log_attempts"] + 1,
+                     last_error=None)
+        with self._lock:
+            stats["logged"] += 1
+
+    def _retry(self, job, counter, policy, retry_status, final_status, error, permanent=False, **fields):
+        attempts = job[counter] + 1
+        max_attempts, base_delay = policy
+        if permanent or attempts >= max_attempts:
+            status, next_attempt = final_status, time.time()
+        else:
+            delay = min(base_delay * 2 ** (attempts - 1), RETRY_MAX_SECONDS) * random.uniform(0.8, 1.2)
+            status, next_attempt = retry_status, time.time() + delay
+        logger.warning("Outbox %s for %s failed (attempt %d): %s", counter.split("_")[0], job["to_addr"],
+                       attempts, error)
+        self._update(job["key"], status=status, last_error=str(error)[:500], next_attempt=next_attempt,
+                     **{counter: attempts}, **fields)
+
+    # ——— internals ————————————————————————————————————
+    def _claim(self, status):
+        """Next due job in status ("queued" or "sent"), moved to its in-flight status ("sending" or "logging")"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT * FROM jobs WHERE account = ? AND status = ? AND next_attempt <= ?"
+                " ORDER BY next_attempt, created LIMIT 1", (self.account, status, time.time()))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            job = dict(zip([c[0] for c in cursor.description], row))
+            job["status"] = "sending" if status == "queued" else "logging"
+            self._conn.execute("UPDATE jobs SET status = ?, updated = ? WHERE key = ?",
+                               (job["status"], time.time(), job["key"]))
+            self._conn.commit()
+            self.version += 1
+            return job
+
+    def _upcoming(self, limit):
+        """The queued jobs that will be claimed next, in claim order"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT key, org, deal_id FROM jobs WHERE account = ? AND status = 'queued' AND next_attempt <= ?"
+                " ORDER BY next_attempt, created LIMIT ?", (self.account, time.time(), limit))
+            return [{"key": key, "org": org, "deal_id": deal_id} for key, org, deal_id in cursor.fetchall()]
+
+    def _next_due(self):
+        """Seconds until the next waiting job is due, or None if nothing is waiting"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT MIN(next_attempt) FROM jobs WHERE account = ? AND status IN ('queued', 'sent')",
+                (self.account,)).fetchone()
+        return None if row[0] is None else row[0] - time.time()
+
+    def _update(self, key, **fields):
+        fields["updated"] = time.time()
+        with self._lock:
+            self._conn.execute(f"UPDATE jobs SET {', '.join(f'{name} = ?' for name in fields)} WHERE key = ?",
+                               (*fields.values(), key))
+            self._conn.commit()
+            self.version += 1
+
+
+def _close_sender(sender):
+    sender.close()
+    if sender.sent:
+        logger.info("Outbox sent %d emails at %.1f msg/s over %d SMTP connection(s)",
+                    sender.sent, sender.messages_per_second, sender.connects)
+
+
+@st.cache_resource
+def get_outbox(account):
+    """The outbox of one account (see account_key), shared by every session sending as it"""
+    return Outbox(account)
@@ -0,0 +1,113 @@
+import io
+import os
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Kept free of streamlit imports: worker processes re-import this module
+from PyPDF2 import PdfReader
+
+# Worker count for page extraction (1 disables the pool)
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", min(os.cpu_count() or 1, 8)))
+# Below this many pages the IPC overhead outweighs the parallelism
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", 24))
+
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+def _open_reader(source):
+    """source is either the PDF bytes or a path to the PDF on disk"""
+    if isinstance(source, (bytes, bytearray)):
+        return PdfReader(io.BytesIO(source))
+    return PdfReader(source)
+
+
+def _extract_page_range(source, start, stop):
+    """Extract pages [start, stop) -> list of (page_index, text, error)"""
+    return _extract_pages(_open_reader(source), start, stop)
+
+
+def _extract_pages(reader, start, stop):
+    results = []
+    for page_index in range(start, stop):
+        try:
+            results.append((page_index, reader.pages[page_index].extract_text() or "", None))
+        except Exception as e:
+            results.append((page_index, "", str(e)))
+    return results
+
+
+def _get_pool(workers):
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            # spawn, not fork: the Streamlit server is multi-threaded
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            _pool_workers = workers
+        return _pool
+
+
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+        _pool = None
+
+
+def page_ranges(num_pages, workers):
+    """Split num_pages into one contiguous range per worker, since each range re-parses the file"""
+    parts = max(1, min(num_pages, workers))
+    step, extra = divmod(num_pages, parts)
+    ranges = []
+    start = 0
+    for i in range(parts):
+        stop = start + step + (1 if i < extra else 0)
+        if stop > start:
+            ranges.append((start, stop))
+        start = stop
+    return ranges
+
+
+def extract_pdf_pages(source, workers=None):
+    """Extract every page of a PDF, in page order, as (page_index, text, error) tuples"""
+    workers = PDF_EXTRACT_WORKERS if workers is None else workers
+    reader = _open_reader(source)
+    num_pages = len(reader.pages)
+
+    if workers <= 1 or num_pages < PDF_PARALLEL_MIN_PAGES:
+        return _extract_pages(reader, 0, num_pages)
+
+    path = None
+    try:
+        if isinstance(source, (bytes, bytearray)):
+            # Workers open one temp file by path instead of each receiving a pickled copy
+            with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp:
+                tmp.write(source)
+            path = source = tmp.name
+        pool = _get_pool(workers)
+        futures = [pool.submit(_extract_page_range, source, start, stop)
+                   for start, stop in page_ranges(num_pages, workers)]
+        pages = []
+        for future in futures:
+            pages.extend(future.result())
+        return pages
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM on a pathological page) - retry inline
+        _reset_pool()
+        return _extract_pages(reader, 0, num_pages)
+    except OSError:
+        # No room for the temp file
+        return _extract_pages(reader, 0, num_pages)
+    finally:
+        if path is not None:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
@@ -0,0 +1,200 @@
+import os
+import time
+import random
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from rate_limit import TokenBucket
+
+PIPEDRIVE_CONNECT_TIMEOUT = float(os.getenv("PIPEDRIVE_CONNECT_TIMEOUT", 5))
+PIPEDRIVE_READ_TIMEOUT = float(os.getenv("PIPEDRIVE_READ_TIMEOUT", 30))
+PIPEDRIVE_MAX_RETRIES = int(os.getenv("PIPEDRIVE_MAX_RETRIES", 3))
+# Seconds an org's deal id is reused before searching again
+PIPEDRIVE_DEAL_CACHE_TTL = float(os.getenv("PIPEDRIVE_DEAL_CACHE_TTL", 600))
+PIPEDRIVE_POOL_SIZE = int(os.getenv("PIPEDRIVE_POOL_SIZE", 10))
+# Request rate and burst kept under the account's API limit; retries count too
+PIPEDRIVE_RATE_PER_SECOND = float(os.getenv("PIPEDRIVE_RATE_PER_SECOND", 10))
+PIPEDRIVE_BURST = int(os.getenv("PIPEDRIVE_BURST", 20))
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 30
+PAGE_SIZE = 500
+DEAL_TITLE_SUFFIX = " – Demo Follow-Up"
+
+
+class PipedriveError(Exception):
+    pass
+
+
+def pipedrive_base_url(domain):
+    """API root for a company domain; PIPEDRIVE_BASE_URL overrides it, e.g. for a local mock server"""
+    return os.getenv("PIPEDRIVE_BASE_URL") or f"https://{domain}.pipedrive.com/api/v1"
+
+
+class PipedriveClient:
+    """Pipedrive API over a pooled keep-alive session, with timeouts, retries and an org -> deal cache.
+
+    Every request, retries included, first takes a token from the client's
+    bucket, so concurrent callers share one rate limit.
+
+    GETs are retried on 429, 5xx and connection errors with exponential
+    backoff (honouring Retry-After). Writes are only retried when the server
+    certainly did not act on them: 429 responses and failed connects.
+    find_or_create_deal is single-flight per org, so concurrent sends to
+    the same org search and create the deal once. With a mirror (see
+    pipedrive_mirror) it matches locally first and only searches remotely
+    for orgs the mirror can't match for certain.
+    """
+
+    def __init__(self, base_url, api_token, max_retries=PIPEDRIVE_MAX_RETRIES,
+                 timeout=(PIPEDRIVE_CONNECT_TIMEOUT, PIPEDRIVE_READ_TIMEOUT), deal_cache_ttl=PIPEDRIVE_DEAL_CACHE_TTL,
+                 mirror=None, rate=PIPEDRIVE_RATE_PER_SECOND, burst=PIPEDRIVE_BURST):
+        self.base_url = base_url.rstrip("/")
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.deal_cache_ttl = deal_cache_ttl
+        self.session = requests.Session()
+        self.session.params = {"api_token": api_token}
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=PIPEDRIVE_POOL_SIZE)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.mirror = mirror
+        self.bucket = TokenBucket(rate, burst)
+        self.requests_made = 0
+        self._deals = {}  # normalized org -> (deal_id, expires_at)
+        self._org_locks = {}
+        self._lock = threading.Lock()
+
+    # ——— API calls ——————————————————————————————————
+    def search_deal(self, org):
+        """Id of the best search hit whose title or organization certainly is org, or None"""
+        # pipedrive_mirror imports this module
+        from pipedrive_mirror import same_org
+
+        # Not exact_match: that compares whole titles, which carry DEAL_TITLE_SUFFIX
+        data = self._request("GET", "deals/search", params={"term": org})
+        for item in (data or {}).get("items") or []:
+            deal = item.get("item") or {}
+            names = [deal.get("title"), (deal.get("organization") or {}).get("name")]
+            if any(name and same_org(org, name) for name in names):
+                return deal["id"]
+        return None
+
+    def create_deal(self, org, org_id=None):
+        payload = {"title": f"{org}{DEAL_TITLE_SUFFIX}", "status": "open"}
+        if org_id is not None:
+            payload["org_id"] = org_id
+        return self._request("POST", "deals", json=payload)
+
+    def log_activity(self, deal_id, subject, note):
+        return self._request("POST", "activities", json={
+            "subject": subject, "note": note, "deal_id": deal_id, "type": "email", "done": 1})
+
+    def find_or_create_deal(self, org):
+        key = " ".join(org.lower().split())
+        deal_id = self._cached_deal(key)
+        if deal_id is not None:
+            return deal_id
+        with self._lock:
+            org_lock = self._org_locks.setdefault(key, threading.Lock())
+        with org_lock:
+            # Whoever held the lock may have just found or created it
+            deal_id = self._cached_deal(key)
+            if deal_id is None:
+                deal_id, org_id = self.mirror.match(org) if self.mirror is not None else (None, None)
+                if deal_id is None and org_id is None:
+                    # Nothing local is certainly org; the search is held to the same standard
+                    deal_id = self.search_deal(org)
+                if deal_id is None:
+                    deal = self.create_deal(org, org_id)
+                    deal_id = deal["id"]
+                    if self.mirror is not None:
+                        self.mirror.upsert_deals([deal])
+                self.remember_deal(org, deal_id)
+            return deal_id
+
+    def remember_deal(self, org, deal_id):
+        key = " ".join(org.lower().split())
+        with self._lock:
+            self._deals[key] = (deal_id, time.monotonic() + self.deal_cache_ttl)
+
+    def paginate(self, path, params=None):
+        """Every item of a paginated list endpoint"""
+        start = 0
+        while True:
+            body = self._call("GET", path, params={**(params or {}), "start": start, "limit": PAGE_SIZE})
+            yield from body.get("data") or []
+            pagination = (body.get("additional_data") or {}).get("pagination") or {}
+            if not pagination.get("more_items_in_collection"):
+                return
+            start = pagination.get("next_start", start + PAGE_SIZE)
+
+    def close(self):
+        self.session.close()
+
+    # ——— internals ————————————————————————————————————
+    def _cached_deal(self, key):
+        with self._lock:
+            entry = self._deals.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self._deals[key]
+                return None
+            return entry[0]
+
+    def _request(self, method, path, **kwargs):
+        return self._call(method, path, **kwargs).get("data")
+
+    def _call(self, method, path, **kwargs):
+        """The decoded response body; raises PipedriveError once retries are exhausted"""
+        url = f"{self.base_url}/{path}"
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            self.bucket.acquire()
+            with self._lock:
+                self.requests_made += 1
+            try:
+                resp = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except requests.ConnectionError as e:
+                # A failed connect never reached the server; a dropped connection may have
+                retryable = method == "GET" or _never_sent(e)
+                if not retryable or attempt == self.max_retries:
+                    raise PipedriveError(f"{method} {path}: {e}") from e
+            except requests.Timeout as e:
+                if method != "GET" or attempt == self.max_retries:
+                    raise PipedriveError(f"{method} {path}: {e}") from e
+            else:
+                retryable = resp.status_code == 429 or (method == "GET" and resp.status_code in RETRY_STATUSES)
+                if not retryable or attempt == self.max_retries:
+                    return _body(resp, method, path)
+                retry_after = resp.headers.get("Retry-After")
+            time.sleep(_backoff(attempt, retry_after))
+
+
+def _never_sent(error):
+    """Whether a ConnectionError happened while connecting, before the request went out"""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    return isinstance(getattr(error.args[0] if error.args else None, "reason", None), NewConnectionError)
+
+
+def _backoff(attempt, retry_after=None):
+    try:
+        return min(float(retry_after), BACKOFF_MAX_SECONDS)
+    except (TypeError, ValueError):
+        return min(BACKOFF_BASE_SECONDS * 2 ** attempt, BACKOFF_MAX_SECONDS) * random.uniform(0.5, 1)
+
+
+def _body(resp, method, path):
+    try:
+        body = resp.json()
+    except ValueError:
+        body = {}
+    if resp.status_code >= 400 or not body.get("success", False):
+        message = body.get("error") or resp.reason or "unsuccessful response"
+        raise PipedriveError(f"{method} {path}: HTTP {resp.status_code} {message}")
+    return body
@@ -0,0 +1,290 @@
+import os
+import re
+import time
+import logging
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+from pipedrive_client import DEAL_TITLE_SUFFIX, PipedriveError
+
+logger = logging.getLogger(__name__)
+
+PIPEDRIVE_MIRROR_DIR = os.getenv("PIPEDRIVE_MIRROR_DIR", os.path.dirname(os.path.abspath(__file__)))
+# Seconds between delta syncs; matching triggers one when the mirror is older than this
+PIPEDRIVE_SYNC_INTERVAL = float(os.getenv("PIPEDRIVE_SYNC_INTERVAL", 300))
+# Trigram Dice similarity at or above which two names whose words all correspond are the same org
+PIPEDRIVE_MATCH_THRESHOLD = float(os.getenv("PIPEDRIVE_MATCH_THRESHOLD", 0.85))
+# Weaker similarity at which a name is offered as a possible match for a person to confirm
+PIPEDRIVE_CANDIDATE_THRESHOLD = float(os.getenv("PIPEDRIVE_CANDIDATE_THRESHOLD", 0.6))
+# Trigram-sharing candidates scored per lookup
+MATCH_CANDIDATES = 50
+
+LEGAL_SUFFIXES = {"inc", "incorporated", "llc", "ltd", "limited", "co", "corp", "corporation", "company",
+                  "gmbh", "plc", "pty", "lp", "llp"}
+NON_WORD_RE = re.compile(r"[^\w\s]+")
+# Words that never tell two orgs apart
+NAME_STOPWORDS = {"the", "and", "of"}
+
+
+def normalize_name(name):
+    """Lowercase, punctuation-free name without legal-form suffixes, e.g. "ACME Golf, Inc." -> "acme golf" """
+    words = NON_WORD_RE.sub(" ", name.lower().replace("&", " and ")).split()
+    while len(words) > 1 and words[-1] in LEGAL_SUFFIXES:
+        words.pop()
+    return " ".join(words)
+
+
+def trigrams(norm):
+    padded = f"  {norm} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def dice(a, b):
+    return 2 * len(a & b) / (len(a) + len(b)) if a or b else 1.0
+
+
+def same_words(a, b):
+    """Whether every distinctive word of two normalized names has a counterpart in the other.
+
+    Words must be equal, except that longer ones may differ by a typo, so
+    "acme golf east" and "acme golf west" or "... club" and "... course" differ.
+    """
+    words_a = [w for w in a.split() if w not in NAME_STOPWORDS]
+    words_b = [w for w in b.split() if w not in NAME_STOPWORDS]
+
+    def close(x, y):
+        return x == y or (min(len(x), len(y)) >= 5 and dice(trigrams(x), trigrams(y)) >= 0.75)
+
+    return all(any(close(x, y) for y in words_b) for x in words_a) and \
+        all(any(close(y, x) for x in words_a) for y in words_b)
+
+
+def deal_name(title):
+    """A deal title without the suffix this app gives the deals it creates"""
+    return title[:-len(DEAL_TITLE_SUFFIX)] if title.endswith(DEAL_TITLE_SUFFIX) else title
+
+
+def same_org(name, other, threshold=PIPEDRIVE_MATCH_THRESHOLD):
+    """Whether two org names or deal titles certainly name one org, by the rule match() applies"""
+    a, b = normalize_name(deal_name(name)), normalize_name(deal_name(other))
+    if not a or not b:
+        return False
+    return a == b or (dice(trigrams(a), trigrams(b)) >= threshold and same_words(a, b))
+
+
+class PipedriveMirror:
+    """Local SQLite copy of an account's organizations and deals for instant org -> deal matching.
+
+    The first sync pages through every org and deal; later ones fetch only
+    what changed since the newest update_time seen, via /recents. Names
+    (org names, and deal titles without the follow-up suffix) are indexed
+    by normalized form and by trigram. match() only accepts a name that is
+    the same once normalized ("ACME Golf, Inc." is "Acme Golf") or very
+    close with every word accounted for; weaker hits such as "Acme Golf
+    Club" are only returned by candidates(), for a person to confirm.
+    """
+
+    def __init__(self, client, path, sync_interval=PIPEDRIVE_SYNC_INTERVAL, threshold=PIPEDRIVE_MATCH_THRESHOLD,
+                 candidate_threshold=PIPEDRIVE_CANDIDATE_THRESHOLD):
+        self.client = client
+        self.path = path
+        self.sync_interval = sync_interval
+        self.threshold = threshold
+        self.candidate_threshold = candidate_threshold
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS organizations (id INTEGER PRIMARY KEY, name TEXT, update_time TEXT);"
+            "CREATE TABLE IF NOT EXISTS deals (id INTEGER PRIMARY KEY, title TEXT, org_id INTEGER, status TEXT,"
+            " update_time TEXT);"
+            "CREATE INDEX IF NOT EXISTS deals_org ON deals (org_id);"
+            # kind is 'org' or 'deal'; gram_count is the size of the name's trigram set
+            "CREATE TABLE IF NOT EXISTS names (kind TEXT, id INTEGER, norm TEXT, gram_count INTEGER,"
+            " PRIMARY KEY (kind, id));"
+            "CREATE INDEX IF NOT EXISTS names_norm ON names (norm);"
+            "CREATE TABLE IF NOT EXISTS name_trigrams (gram TEXT, kind TEXT, id INTEGER);"
+            "CREATE INDEX IF NOT EXISTS name_trigrams_gram ON name_trigrams (gram);"
+            "CREATE INDEX IF NOT EXISTS name_trigrams_item ON name_trigrams (kind, id);"
+            "CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT);"
+        )
+        self._conn.commit()
+
+    # ——— Matching ——————————————————————————————————————
+    def match(self, org):
+        """(deal_id, org_id) for the org or deal that certainly is org; either may be None.
+
+        An org match without a deal returns (None, org_id) so the caller can
+        create the deal under that org.
+        """
+        self.maybe_sync()
+        norm = normalize_name(org)
+        if not norm:
+            return None, None
+        hit = self._accepted(norm)
+        return self._resolve(*hit) if hit is not None else (None, None)
+
+    def candidates(self, org, limit=3):
+        """Deals that may be org's but fall short of match(), best first, for a person to confirm.
+
+        Each is a dict of deal_id, org_id, name and score. Empty when match()
+        would accept a name by itself. Only what is already mirrored is searched.
+        """
+        norm = normalize_name(org)
+        if not norm or self._accepted(norm) is not None:
+            return []
+        found = []
+        for score, kind, item_id, _ in self._scored(norm):
+            if score < self.candidate_threshold or len(found) == limit:
+                break
+            deal_id, org_id = self._resolve(kind, item_id)
+            if deal_id is None or any(c["deal_id"] == deal_id for c in found):
+                continue
+            name = self._scalar("SELECT title FROM deals WHERE id = ?", (deal_id,))
+            found.append({"deal_id": deal_id, "org_id": org_id, "name": name, "score": round(score, 2)})
+        return found
+
+    def _accepted(self, norm):
+        """(kind, id) of an exact normalized match, else of a close one with every word accounted for"""
+        with self._lock:
+            row = self._conn.execute("SELECT kind, id FROM names WHERE norm = ? ORDER BY kind = 'deal' DESC LIMIT 1",
+                                     (norm,)).fetchone()
+        if row:
+            return tuple(row)
+        for score, kind, item_id, other in self._scored(norm):
+            if score < self.threshold:
+                break
+            if same_words(norm, other):
+                return kind, item_id
+        return None
+
+    def _scored(self, norm):
+        """(Dice score, kind, id, norm) of the names sharing the most trigrams with norm, best first"""
+        grams = trigrams(norm)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT t.kind, t.id, COUNT(DISTINCT t.gram), n.gram_count, n.norm FROM name_trigrams t"
+                " JOIN names n ON n.kind = t.kind AND n.id = t.id"
+                f" WHERE t.gram IN ({','.join('?' * len(grams))}) GROUP BY t.kind, t.id"
+                " ORDER BY COUNT(DISTINCT t.gram) DESC LIMIT ?", (*grams, MATCH_CANDIDATES)).fetchall()
+        scored = [(2 * shared / (len(grams) + gram_count), kind, item_id, other)
+                  for kind, item_id, shared, gram_count, other in rows]
+        # Prefer deals on ties: that is what the caller needs
+        scored.sort(key=lambda hit: (hit[0], hit[1] == "deal"), reverse=True)
+        return scored
+
+    def _resolve(self, kind, item_id):
+        """(deal_id, org_id) for a matched name: the deal itself, or the org's most relevant deal"""
+        if kind == "deal":
+            return item_id, self._scalar("SELECT org_id FROM deals WHERE id = ?", (item_id,))
+        deal_id = self._scalar("SELECT id FROM deals WHERE org_id = ? AND status != 'deleted'"
+                               " ORDER BY status = 'open' DESC, update_time DESC LIMIT 1", (item_id,))
+        return deal_id, item_id
+
+    # ——— Sync ——————————————————————————————————————————
+    def maybe_sync(self):
+        """Delta sync if the mirror is stale; a failed sync is logged and matching uses what is already local"""
+        # Callers arriving mid-sync wait for it rather than matching on stale data
+        with self._sync_lock:
+            if time.time() - float(self._state("last_sync") or 0) < self.sync_interval:
+                return
+            try:
+                self._sync()
+            except PipedriveError as e:
+                logger.warning("Pipedrive mirror sync failed: %s", e)
+
+    def sync(self):
+        """Pull changes since the newest update_time seen; a full pull the first time. Returns items applied."""
+        with self._sync_lock:
+            return self._sync()
+
+    def upsert_orgs(self, orgs):
+        with self._lock:
+            for org in orgs:
+                if not org.get("id"):
+                    continue
+                if org.get("active_flag") is False:
+                    self._delete("org", org["id"], "organizations")
+                    continue
+                self._conn.execute("INSERT OR REPLACE INTO organizations (id, name, update_time) VALUES (?, ?, ?)",
+                                   (org["id"], org.get("name") or "", org.get("update_time")))
+                self._index("org", org["id"], org.get("name") or "")
+            self._conn.commit()
+
+    def upsert_deals(self, deals):
+        with self._lock:
+            for deal in deals:
+                if not deal.get("id"):
+                    continue
+                if deal.get("status") == "deleted" or deal.get("deleted"):
+                    self._delete("deal", deal["id"], "deals")
+                    continue
+                org_id = deal.get("org_id")
+                if isinstance(org_id, dict):
+                    org_id = org_id.get("value")
+                title = deal.get("title") or ""
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO deals (id, title, org_id, status, update_time) VALUES (?, ?, ?, ?, ?)",
+                    (deal["id"], title, org_id, deal.get("status"), deal.get("update_time")))
+                self._index("deal", deal["id"], deal_name(title))
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            orgs = self._conn.execute("SELECT COUNT(*) FROM organizations").fetchone()[0]
+            deals = self._conn.execute("SELECT COUNT(*) FROM deals").fetchone()[0]
+        last = float(self._state("last_sync") or 0)
+        return {"organizations": orgs, "deals": deals, "last_sync": last or None}
+
+    # ——— internals ————————————————————————————————————
+    def _sync(self):
+        since = self._state("since")
+        started = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        if since is None:
+            orgs = list(self.client.paginate("organizations"))
+            deals = list(self.client.paginate("deals", {"status": "all_not_deleted"}))
+        else:
+            orgs, deals = [], []
+            for change in self.client.paginate("recents", {"since_timestamp": since, "items": "deal,organization"}):
+                (deals if change.get("item") == "deal" else orgs).append(change.get("data") or {})
+        self.upsert_orgs(orgs)
+        self.upsert_deals(deals)
+        # Pipedrive's update_time is UTC "YYYY-MM-DD HH:MM:SS", so it compares as text. The server's
+        # clock is preferred; ours is only used when the account has nothing in it yet.
+        newest = max([item.get("update_time") or "" for item in orgs + deals] + [since or ""]) or started
+        self._set_state(since=newest, last_sync=str(time.time()))
+        logger.info("Pipedrive mirror synced %d organizations and %d deals", len(orgs), len(deals))
+        return len(orgs) + len(deals)
+
+    def _index(self, kind, item_id, name):
+        norm = normalize_name(name)
+        grams = trigrams(norm) if norm else set()
+        self._conn.execute("DELETE FROM name_trigrams WHERE kind = ? AND id = ?", (kind, item_id))
+        self._conn.execute("INSERT OR REPLACE INTO names (kind, id, norm, gram_count) VALUES (?, ?, ?, ?)",
+                           (kind, item_id, norm, len(grams)))
+        self._conn.executemany("INSERT INTO name_trigrams (gram, kind, id) VALUES (?, ?, ?)",
+                               [(gram, kind, item_id) for gram in grams])
+
+    def _delete(self, kind, item_id, table):
+        self._conn.execute(f"DELETE FROM {table} WHERE id = ?", (item_id,))
+        self._conn.execute("DELETE FROM names WHERE kind = ? AND id = ?", (kind, item_id))
+        self._conn.execute("DELETE FROM name_trigrams WHERE kind = ? AND id = ?", (kind, item_id))
+
+    def _scalar(self, sql, params):
+        with self._lock:
+            row = self._conn.execute(sql, params).fetchone()
+        return row[0] if row else None
+
+    def _state(self, key):
+        return self._scalar("SELECT value FROM sync_state WHERE key = ?", (key,))
+
+    def _set_state(self, **values):
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)", values.items())
+            self._conn.commit()
+
+
+def mirror_path(domain):
+    return os.path.join(PIPEDRIVE_MIRROR_DIR, f".pipedrive_mirror-{re.sub(r'[^A-Za-z0-9_-]', '_', domain)}.sqlite")
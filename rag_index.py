@@ -0,0 +1,523 @@
+import os
+import json
+import math
+import time
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Any
+
+import numpy as np
+import streamlit as st
+from langchain.schema import BaseRetriever
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_community.vectorstores import FAISS
+
+from embedding_cache import CachedEmbeddings, get_embedding_store
+from local_retrieval import BM25Index, BM25Retriever, HybridRetriever
+
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+# Saved indexes, one directory per corpus fingerprint ("" disables persistence)
+INDEX_DIR = os.getenv("RAG_INDEX_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".rag_indexes"))
+# faiss index_factory string for new indexes: "Flat" (exact), "HNSW32", "SQ8", "IVF{nlist},SQ8",
+# "IVF{nlist},PQ32", or with a "PCA256," prefix to reduce dimensions. {nlist} scales with corpus size.
+INDEX_FACTORY = os.getenv("RAG_INDEX_FACTORY", "Flat")
+# Indexes that need training fall back to Flat below this many vectors
+INDEX_MIN_TRAIN = int(os.getenv("RAG_INDEX_MIN_TRAIN", 1000))
+INDEX_NPROBE = int(os.getenv("RAG_INDEX_NPROBE", 16))
+INDEX_EF_SEARCH = int(os.getenv("RAG_INDEX_EF_SEARCH", 64))
+
+
+def embedding_model_name(embeddings):
+    return getattr(embeddings, "model", None) or type(embeddings).__name__
+
+
+def corpus_fingerprint(file_chunks, model_name, chunk_size, chunk_overlap, index_factory=INDEX_FACTORY):
+    """Hash of (chunk texts, embedding model, chunk and index params) identifying one vector index"""
+    digest = hashlib.sha256(f"{model_name}\0{chunk_size}\0{chunk_overlap}\0{index_factory}\0".encode('utf-8'))
+    for key in sorted(file_chunks):
+        digest.update(f"{key[0]}\0{key[1]}\0".encode('utf-8'))
+        for chunk_id, chunk in file_chunks[key]:
+            digest.update(chunk_id.encode('utf-8'))
+            digest.update(chunk.page_content.encode('utf-8'))
+            digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def make_faiss_index(vectors, factory=INDEX_FACTORY):
+    """Empty (but trained) faiss index for vectors, built from an index_factory string"""
+    import faiss
+
+    n, dim = vectors.shape
+    index = faiss.index_factory(dim, factory.format(nlist=max(1, int(4 * math.sqrt(n)))))
+    if not index.is_trained:
+        if n < INDEX_MIN_TRAIN:
+            return faiss.IndexFlatL2(dim)
+        try:
+            index.train(vectors)
+        except RuntimeError:
+            # e.g. fewer vectors than PQ centroids
+            return faiss.IndexFlatL2(dim)
+    tune_index(index)
+    return index
+
+
+def is_training_fallback(index, factory):
+    """Whether index is the Flat stand-in make_faiss_index returns for a factory that needs training"""
+    import faiss
+
+    if not isinstance(faiss.downcast_index(index), faiss.IndexFlat):
+        return False
+    return not faiss.index_factory(index.d, factory.format(nlist=1)).is_trained
+
+
+def removes_in_place(index):
+    """Whether remove_ids compacts index to ids 0..n-1, as LangChain's FAISS.delete assumes"""
+    import faiss
+
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexPreTransform):
+        return removes_in_place(index.index)
+    return isinstance(index, faiss.IndexFlatCodes)
+
+
+def tune_index(index, nprobe=INDEX_NPROBE, ef_search=INDEX_EF_SEARCH):
+    """Apply the search-time recall/speed knobs the index type has"""
+    import faiss
+
+    space = faiss.ParameterSpace()
+    for name, value in (("nprobe", nprobe), ("efSearch", ef_search)):
+        try:
+            space.set_index_parameter(index, name, value)
+        except RuntimeError:
+            pass  # not an IVF / HNSW index
+
+
+def search_params(index, selector):
+    """faiss SearchParameters restricting a search to selector, of the type the index expects.
+
+    None for indexes that can't take a selector (flat PQ), which the caller post-filters.
+    """
+    import faiss
+
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexPreTransform):
+        # PCA etc. keep vector ids; the wrapped index does the selecting
+        return faiss.SearchParametersPreTransform(index_params=search_params(index.index, selector))
+    if isinstance(index, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=index.nprobe)
+    if isinstance(index, faiss.IndexHNSW):
+        # Includes HNSW over SQ / PQ codes
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=index.hnsw.efSearch)
+    if isinstance(index, faiss.IndexPQ):
+        return None
+    return faiss.SearchParameters(sel=selector)
+
+
+def index_memory_bytes(index):
+    """Approximate in-memory size of a faiss index (its serialized size)"""
+    import faiss
+
+    return int(faiss.serialize_index(index).size)
+
+
+def build_vectorstore(text_embeddings, embeddings, metadatas, ids, factory=INDEX_FACTORY):
+    """FAISS store over precomputed vectors using the configured index type"""
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+
+    vectors = np.array([vector for _, vector in text_embeddings], dtype=np.float32)
+    vectorstore = FAISS(embeddings, make_faiss_index(vectors, factory), InMemoryDocstore(), {})
+    vectorstore.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+    return vectorstore
+
+
+def load_persisted_index(fingerprint, embeddings, index_dir=INDEX_DIR):
+    """Load a saved index for fingerprint, or None if there isn't one"""
+    if not index_dir:
+        return None
+    path = os.path.join(index_dir, fingerprint)
+    if not os.path.isfile(os.path.join(path, "index.faiss")):
+        return None
+    try:
+        # Only ever reads pickles this app wrote itself
+        vectorstore = FAISS.load_local(path, embeddings, allow_dangerous_deserialization=True)
+    except Exception:
+        shutil.rmtree(path, ignore_errors=True)
+        return None
+    tune_index(vectorstore.index)
+    _touch_meta(path)
+    return vectorstore
+
+
+def save_index(vectorstore, fingerprint, meta, index_dir=INDEX_DIR):
+    """Write vectorstore under index_dir/fingerprint atomically"""
+    if not index_dir:
+        return
+    path = os.path.join(index_dir, fingerprint)
+    if os.path.isdir(path):
+        return
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        vectorstore.save_local(tmp_path)
+        now = time.time()
+        with open(os.path.join(tmp_path, "meta.json"), 'w') as f:
+            json.dump(dict(meta, fingerprint=fingerprint, created=now, last_used=now), f)
+        os.rename(tmp_path, path)
+    except OSError:
+        # Another process saved the same corpus first, or the disk is unwritable
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def _touch_meta(path):
+    meta_path = os.path.join(path, "meta.json")
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        meta["last_used"] = time.time()
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+    except (OSError, ValueError):
+        pass
+
+
+def list_indexes(index_dir=INDEX_DIR):
+    """Saved indexes as meta dicts (with path and size_bytes), most recently used first"""
+    if not index_dir or not os.path.isdir(index_dir):
+        return []
+    indexes = []
+    for name in os.listdir(index_dir):
+        path = os.path.join(index_dir, name)
+        if name.endswith(".tmp") or not os.path.isdir(path):
+            continue
+        try:
+            with open(os.path.join(path, "meta.json")) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = {"fingerprint": name, "last_used": os.path.getmtime(path)}
+        meta["path"] = path
+        meta["size_bytes"] = sum(
+            os.path.getsize(os.path.join(path, f)) for f in os.listdir(path)
+            if os.path.isfile(os.path.join(path, f)))
+        indexes.append(meta)
+    indexes.sort(key=lambda m: m.get("last_used", 0), reverse=True)
+    return indexes
+
+
+def gc_indexes(index_dir=INDEX_DIR, max_age_days=None, max_bytes=None, dry_run=False):
+    """Delete indexes unused for max_age_days, then least recently used ones beyond max_bytes"""
+    removed = []
+    total = 0
+    cutoff = time.time() - max_age_days * 86400 if max_age_days is not None else None
+    for meta in list_indexes(index_dir):
+        stale = cutoff is not None and meta.get("last_used", 0) < cutoff
+        over_budget = max_bytes is not None and total + meta["size_bytes"] > max_bytes
+        if stale or over_budget:
+            if not dry_run:
+                shutil.rmtree(meta["path"], ignore_errors=True)
+            removed.append(meta)
+        else:
+            total += meta["size_bytes"]
+    return removed
+
+
+def clone_vectorstore(vectorstore):
+    """Independent copy of a FAISS store, so a shared index is never mutated in place"""
+    import faiss
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+
+    return FAISS(
+        embedding_function=vectorstore.embedding_function,
+        index=faiss.clone_index(vectorstore.index),
+        docstore=InMemoryDocstore(dict(vectorstore.docstore._dict)),
+        index_to_docstore_id=dict(vectorstore.index_to_docstore_id),
+        normalize_L2=vectorstore._normalize_L2,
+        distance_strategy=vectorstore.distance_strategy,
+    )
+
+
+class IndexRegistry:
+    """Process-wide LRU of built vector stores keyed by corpus fingerprint.
+
+    Stores handed out here are shared between sessions and must be treated as
+    read-only; IncrementalVectorIndex clones one before applying a delta.
+    """
+
+    def __init__(self, max_entries=int(os.getenv("RAG_INDEX_CACHE_SIZE", 8))):
+        self.max_entries = max_entries
+        self._stores = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, fingerprint):
+        with self._lock:
+            vectorstore = self._stores.get(fingerprint)
+            if vectorstore is not None:
+                self._stores.move_to_end(fingerprint)
+            return vectorstore
+
+    def put(self, fingerprint, vectorstore):
+        with self._lock:
+            self._stores[fingerprint] = vectorstore
+            self._stores.move_to_end(fingerprint)
+            while len(self._stores) > self.max_entries:
+                self._stores.popitem(last=False)
+
+
+@st.cache_resource
+def get_index_registry():
+    """Vector stores shared by every session and app in this process"""
+    return IndexRegistry()
+
+
+class IncrementalVectorIndex:
+    """FAISS store that tracks chunks per ingested file so uploads can be added/removed in place"""
+
+    def __init__(self, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, index_dir=INDEX_DIR, registry=None,
+                 embedding_store=None, index_factory=INDEX_FACTORY):
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.index_factory = index_factory
+        self.index_dir = index_dir
+        self.registry = registry
+        self.embedding_store = embedding_store
+        self.splitter = RecursiveCharacterTextSplitter(
+            chunk_size=chunk_size, chunk_overlap=chunk_overlap, add_start_index=True)
+        self.vectorstore = None
+        self.bm25 = BM25Index()
+        self.fingerprint = None
+        self.loaded_from_disk = False
+        self._file_chunks = {}  # file_key -> [(chunk_id, chunk Document)]
+        self._source_ids = {}  # source file name -> int64 array of its faiss ids in self.vectorstore
+
+    @property
+    def file_keys(self):
+        return list(self._file_chunks)
+
+    @property
+    def chunks(self):
+        return [chunk for entries in self._file_chunks.values() for _, chunk in entries]
+
+    def split_file(self, key, docs):
+        entries = []
+        for i, chunk in enumerate(self.splitter.split_documents(docs)):
+            _absolute_offsets(chunk)
+            entries.append((f"{key[0]}|{key[1]}|{i}", chunk))
+        return entries
+
+    def sync(self, files, embeddings):
+        """Make the index match files ({file_key: [Document]}), embedding only new files.
+
+        A corpus that was indexed before is reused instead of being embedded
+        again: from the in-process registry if another session built it, else
+        from disk (earlier runs, or build_index.py).
+        """
+        removed = [key for key in self._file_chunks if key not in files]
+        added = [key for key in files if key not in self._file_chunks]
+        if not removed and not added:
+            return added, removed
+
+        if embeddings is not None and self.embedding_store is not None \
+                and not isinstance(embeddings, CachedEmbeddings):
+            embeddings = CachedEmbeddings(embeddings, self.embedding_store)
+
+        pending = {key: self.split_file(key, files[key]) for key in added}
+        target = {key: self._file_chunks[key] if key in self._file_chunks else pending[key] for key in files}
+        model_name = embedding_model_name(embeddings) if embeddings is not None else "bm25"
+        fingerprint = corpus_fingerprint(target, model_name, self.chunk_size, self.chunk_overlap,
+                                         self.index_factory)
+
+        if not any(target.values()) or embeddings is None:
+            # Nothing to search, or lexical-only: no vectors needed
+            self.vectorstore = None
+            self._source_ids = {}
+        else:
+            stored = self.registry.get(fingerprint) if self.registry is not None else None
+            self.loaded_from_disk = False
+            if stored is None:
+                stored = load_persisted_index(fingerprint, embeddings, self.index_dir)
+                self.loaded_from_disk = stored is not None
+                if stored is not None and self.registry is not None:
+                    self.registry.put(fingerprint, stored)
+
+            if stored is not None:
+                self.vectorstore = stored
+                self._source_ids = source_ids(stored, target)
+            else:
+                if self.vectorstore is not None and self.registry is not None:
+                    # Our current store may be shared with other sessions
+                    self.vectorstore = clone_vectorstore(self.vectorstore)
+                self._apply_delta(removed, pending, embeddings)
+                if self.registry is not None:
+                    self.registry.put(fingerprint, self.vectorstore)
+                save_index(self.vectorstore, fingerprint, {
+                    "model": model_name,
+                    "chunk_size": self.chunk_size,
+                    "chunk_overlap": self.chunk_overlap,
+                    "index": type(self.vectorstore.index).__name__,
+                    "index_factory": self.index_factory,
+                    "files": [key[0] for key in target],
+                    "chunks": sum(len(entries) for entries in target.values()),
+                }, self.index_dir)
+
+        # Only once the vectors are in, so a failed embedding leaves both indexes on the old files
+        self._update_bm25(removed, pending)
+        self._file_chunks = target
+        self.fingerprint = fingerprint
+        return added, removed
+
+    def _update_bm25(self, removed, pending):
+        for key in removed:
+            for chunk_id, _ in self._file_chunks[key]:
+                self.bm25.remove(chunk_id)
+        for entries in pending.values():
+            for chunk_id, chunk in entries:
+                self.bm25.add(chunk_id, chunk)
+
+    def _apply_delta(self, removed, pending, embeddings):
+        """Delete removed files' vectors and add pending ones; self._file_chunks is left for sync() to update"""
+        remaining = {key: entries for key, entries in self._file_chunks.items() if key not in removed}
+        new_ids = [chunk_id for entries in pending.values() for chunk_id, _ in entries]
+        new_chunks = [chunk for entries in pending.values() for _, chunk in entries]
+        # Embed before touching the store, so a failed request leaves it as it was
+        vectors = embeddings.embed_documents([chunk.page_content for chunk in new_chunks]) if new_chunks else []
+
+        ids = [chunk_id for key in removed for chunk_id, _ in self._file_chunks[key]]
+        total = sum(len(entries) for entries in remaining.values()) + len(new_chunks)
+        # A corpus built below INDEX_MIN_TRAIN is Flat; once it has grown enough, train the configured type
+        rebuild = self.vectorstore is None or not remaining or (
+            total >= INDEX_MIN_TRAIN and is_training_fallback(self.vectorstore.index, self.index_factory))
+        if ids and not rebuild:
+            if removes_in_place(self.vectorstore.index):
+                self.vectorstore.delete(ids)
+            else:
+                # HNSW can't remove vectors and IVF keeps its ids sparse, which
+                # FAISS.delete's renumbering doesn't expect: rebuild from the files that remain
+                rebuild = True
+        if rebuild and remaining:
+            kept = [chunk for entries in remaining.values() for _, chunk in entries]
+            # With an embedding store these all come from the cache
+            vectors = list(embeddings.embed_documents([chunk.page_content for chunk in kept])) + list(vectors)
+            new_ids = [chunk_id for entries in remaining.values() for chunk_id, _ in entries] + new_ids
+            new_chunks = kept + new_chunks
+
+        if new_chunks:
+            text_embeddings = list(zip([chunk.page_content for chunk in new_chunks], vectors))
+            metadatas = [chunk.metadata for chunk in new_chunks]
+            if rebuild:
+                self.vectorstore = build_vectorstore(
+                    text_embeddings, embeddings, metadatas, new_ids, self.index_factory)
+            else:
+                self.vectorstore.add_embeddings(text_embeddings, metadatas=metadatas, ids=new_ids)
+        # Deleting renumbers faiss ids, so the map is rebuilt from the store's id table, not the docstore
+        self._source_ids = source_ids(self.vectorstore, {**remaining, **pending})
+
+    @property
+    def sources(self):
+        return sorted({key[0] for key in self._file_chunks})
+
+    @property
+    def empty(self):
+        return not len(self.bm25)
+
+    def as_retriever(self, sources=None, mode="vector", k=4):
+        """Retriever over the whole index, or only over chunks from the given source files.
+
+        mode is "vector", "bm25", or "hybrid" (reciprocal-rank fusion of both).
+        """
+        lexical = BM25Retriever(index=self.bm25, sources=list(sources) if sources else None, k=k)
+        if mode == "bm25":
+            return lexical
+        if self.vectorstore is None:
+            raise ValueError(f"{mode} retrieval needs embeddings, but this index has none")
+        if not sources:
+            semantic = self.vectorstore.as_retriever(search_kwargs={"k": k})
+        else:
+            ids = [self._source_ids[source] for source in sources if source in self._source_ids]
+            semantic = SourceFilteredRetriever(
+                vectorstore=self.vectorstore, ids=np.concatenate(ids) if ids else np.empty(0, dtype=np.int64), k=k)
+        if mode == "hybrid":
+            return HybridRetriever(retrievers=[semantic, lexical], k=k)
+        return semantic
+
+
+def source_ids(vectorstore, file_chunks):
+    """{source file name: int64 array of faiss ids} for the chunks of file_chunks in vectorstore"""
+    chunk_sources = {chunk_id: key[0] for key, entries in file_chunks.items() for chunk_id, _ in entries}
+    ids = defaultdict(list)
+    for pos, chunk_id in vectorstore.index_to_docstore_id.items():
+        if chunk_id in chunk_sources:
+            ids[chunk_sources[chunk_id]].append(pos)
+    return {source: np.array(positions, dtype=np.int64) for source, positions in ids.items()}
+
+
+def _absolute_offsets(chunk):
+    """Turn the splitter's start_index into char offsets within the original file"""
+    start = chunk.metadata.pop("start_index", None)
+    if start is None or start < 0:
+        return
+    base = chunk.metadata.get("char_start", 0)
+    chunk.metadata["char_start"] = base + start
+    chunk.metadata["char_end"] = base + start + len(chunk.page_content)
+
+
+class SourceFilteredRetriever(BaseRetriever):
+    """Nearest-neighbour search restricted to chunks from selected files.
+
+    ids are the faiss ids of those files' vectors (IncrementalVectorIndex
+    keeps them per source). They are handed to FAISS as an IDSelector, so
+    only that slice of the index is scanned instead of post-filtering a
+    wider top-k. Stores built here are never L2-normalised, so the query
+    vector is used as embedded.
+    """
+
+    vectorstore: Any
+    ids: Any
+    k: int = 4
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        import faiss
+
+        store = self.vectorstore
+        if not len(self.ids):
+            return []
+
+        vector = np.array([store.embedding_function.embed_query(query)], dtype=np.float32)
+        params = search_params(store.index, faiss.IDSelectorBatch(self.ids))
+        if params is None:
+            # A flat scan either way: rank everything and keep the allowed ids
+            _, positions = store.index.search(vector, store.index.ntotal)
+            allowed = set(self.ids.tolist())
+            positions = [[pos for pos in positions[0] if pos in allowed][:self.k]]
+        else:
+            _, positions = store.index.search(vector, min(self.k, len(self.ids)), params=params)
+        docs = []
+        for pos in positions[0]:
+            if pos == -1:
+                continue
+            docs.append(store.docstore.search(store.index_to_docstore_id[int(pos)]))
+        return docs
+
+
+# UI label -> (embedder, retrieval mode); "none" builds no vectors at all
+RETRIEVAL_BACKENDS = {
+    "OpenAI embeddings": ("openai", "vector"),
+    "Local embeddings (offline)": ("local", "vector"),
+    "BM25 keyword search (offline)": ("none", "bm25"),
+    "Hybrid: BM25 + local (offline)": ("local", "hybrid"),
+    "Hybrid: BM25 + OpenAI": ("openai", "hybrid"),
+}
+DEFAULT_RETRIEVAL_BACKEND = os.getenv("RAG_BACKEND", "OpenAI embeddings")
+if DEFAULT_RETRIEVAL_BACKEND not in RETRIEVAL_BACKENDS:
+    DEFAULT_RETRIEVAL_BACKEND = "OpenAI embeddings"
+
+
+def get_session_index(storage_key, embedder="openai"):
+    """Per-session incremental index for one app's uploads and one embedder"""
+    index_key = f'vector_index_{storage_key}_{embedder}'
+    if index_key not in st.session_state:
+        # Local vectors are cheaper to recompute than to fetch from SQLite
+        st.session_state[index_key] = IncrementalVectorIndex(
+            registry=get_index_registry(),
+            embedding_store=get_embedding_store() if embedder == "openai" else None)
+    return st.session_state[index_key]
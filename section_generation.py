@@ -0,0 +1,259 @@
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import List
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.prompts import ChatPromptTemplate
+from pydantic import BaseModel, Field
+
+from context_assembly import CONTEXT_TOKEN_BUDGET, assemble_context, budget_key
+from llm_cache import context_hash
+
+# LLM calls in flight at once when generating sections
+GENERATION_MAX_IN_FLIGHT = int(os.getenv("GENERATION_MAX_IN_FLIGHT", 4))
+# How often streamed sections are redrawn, in seconds
+STREAM_REFRESH_SECONDS = float(os.getenv("STREAM_REFRESH_SECONDS", 0.1))
+
+# A section request, ordered for provider-side prompt caching: system is the stable
+# system message, brief the instructions shared by every section, details the
+# per-request part (topic, tone, dates). Retrieved context always goes last.
+SectionPrompt = namedtuple("SectionPrompt", "system brief details")
+
+# Prompt for the stuff chain built by the apps; the extra "system" input is filled
+# per call by invoke_chain
+SECTION_QA_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "{system}"),
+    ("human", "{question}\n\nUse the following excerpts from the company's documents where relevant:\n{context}"),
+])
+DEFAULT_SYSTEM_PROMPT = "You are a helpful assistant."
+
+
+class TokenBuffer(BaseCallbackHandler):
+    """Collects one section's streamed tokens; appended to from a worker thread"""
+
+    def __init__(self):
+        self.tokens = []
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.tokens.append(token)
+
+    @property
+    def text(self):
+        return "".join(self.tokens)
+
+
+class UsageTracker(BaseCallbackHandler):
+    """Records token usage, including provider-cached input tokens, for every LLM call it is attached to"""
+
+    def __init__(self):
+        self.records = []  # one {"input_tokens", "cached_tokens", "output_tokens"} per call
+        self._lock = threading.Lock()
+
+    def on_llm_end(self, response, **kwargs):
+        usages = [generation.message.usage_metadata for generations in response.generations
+                  for generation in generations if getattr(getattr(generation, "message", None), "usage_metadata", None)]
+        if usages:
+            input_tokens = sum(usage.get("input_tokens", 0) for usage in usages)
+            cached_tokens = sum((usage.get("input_token_details") or {}).get("cache_read", 0) for usage in usages)
+            output_tokens = sum(usage.get("output_tokens", 0) for usage in usages)
+        else:
+            token_usage = (response.llm_output or {}).get("token_usage") or {}
+            input_tokens = token_usage.get("prompt_tokens", 0)
+            cached_tokens = (token_usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+            output_tokens = token_usage.get("completion_tokens", 0)
+        with self._lock:
+            self.records.append({"input_tokens": input_tokens, "cached_tokens": cached_tokens or 0,
+                                 "output_tokens": output_tokens})
+
+    @property
+    def calls(self):
+        return len(self.records)
+
+    @property
+    def input_tokens(self):
+        return sum(record["input_tokens"] for record in self.records)
+
+    @property
+    def cached_tokens(self):
+        return sum(record["cached_tokens"] for record in self.records)
+
+    @property
+    def output_tokens(self):
+        return sum(record["output_tokens"] for record in self.records)
+
+
+class GeneratedSection(BaseModel):
+    topic: str = Field(description="The topic exactly as it was given")
+    content: str = Field(description="The full text of the section, without the topic as a heading")
+
+
+class GeneratedSections(BaseModel):
+    sections: List[GeneratedSection] = Field(description="One entry per topic, in the order given")
+
+
+def invoke_chain(chain, prompt, callbacks=None, cache=None, context_stats=None):
+    """Run a RetrievalQA chain or bare chat model on a SectionPrompt (or plain string) and return the text.
+
+    RetrievalQA chains retrieve with the prompt's details only, fit the
+    documents to the context budget and answer through their stuff chain
+    directly. With a CacheScope, responses are looked up by model,
+    temperature, prompt and a hash of the retrieved documents. The context
+    assembler's stats are appended to the context_stats list if one is given.
+    """
+    if isinstance(prompt, str):
+        prompt = SectionPrompt(None, "", prompt)
+    question = "\n\n".join(part for part in (prompt.brief, prompt.details) if part)
+    cache_text = f"{prompt.system or ''}\0{question}"
+
+    combine = getattr(chain, 'combine_documents_chain', None)
+    if combine is None or not hasattr(chain, 'retriever'):
+        messages = [SystemMessage(content=prompt.system), HumanMessage(content=question)] if prompt.system else question
+        if cache is None:
+            return _run_chain(chain, messages, callbacks)
+        return cache.call(chain, cache_text, lambda: _run_chain(chain, messages, callbacks))
+
+    docs = chain.retriever.invoke(prompt.details)
+    inputs = {"question": question}
+    if "system" in combine.llm_chain.prompt.input_variables:
+        inputs["system"] = prompt.system or DEFAULT_SYSTEM_PROMPT
+    elif prompt.system:
+        inputs["question"] = f"{prompt.system}\n\n{question}"
+
+    def generate():
+        # Assembled here so cache hits skip it, map-reduce calls included
+        inputs["input_documents"] = _assemble(docs, prompt.details, combine.llm_chain.llm, callbacks, context_stats)
+        return combine.invoke(inputs, config={"callbacks": callbacks} if callbacks else None)["output_text"]
+
+    if cache is None:
+        return generate()
+    return cache.call(combine.llm_chain.llm, cache_text, generate, f"{context_hash(docs)}:{budget_key()}")
+
+
+def _assemble(docs, query, llm, callbacks, context_stats, budget=CONTEXT_TOKEN_BUDGET):
+    # Streamed map-reduce notes must not show up in the section's live draft
+    callbacks = [callback for callback in callbacks or [] if not isinstance(callback, TokenBuffer)]
+    docs, stats = assemble_context(docs, query, budget, llm=llm, callbacks=callbacks or None)
+    if context_stats is not None:
+        context_stats.append(stats)
+    return docs
+
+
+def _run_chain(chain, prompt, callbacks=None):
+    if hasattr(chain, 'invoke'):
+        # Pass string directly, not dict
+        result = chain.invoke(prompt, config={"callbacks": callbacks}) if callbacks else chain.invoke(prompt)
+    elif hasattr(chain, 'run'):
+        result = chain.run(prompt, callbacks=callbacks)
+    else:
+        # Fallback for simple ChatOpenAI
+        result = chain.predict(prompt, callbacks=callbacks)
+
+    # Extract text content from result
+    if isinstance(result, dict):
+        return result.get('result', '') or result.get('answer', '') or str(result)
+    if hasattr(result, 'content'):
+        # Handle LangChain response object with content attribute
+        return result.content
+    return str(result)
+
+
+def generate_sections(chain, prompts, on_complete=None, on_update=None, cache=None, callbacks=None,
+                      context_stats=None, max_in_flight=GENERATION_MAX_IN_FLIGHT):
+    """Run one prompt per section concurrently; returns [(text, error)] in prompt order.
+
+    on_complete(index, text, error) is called as each section finishes, and
+    on_update(index, partial_text) as streamed tokens arrive (the chat model
+    must be created with streaming=True). Both run on the caller's thread,
+    so they may update Streamlit elements. cache is an optional CacheScope;
+    callbacks (e.g. a UsageTracker) are attached to every section's call, and
+    per-section context stats are appended to context_stats.
+    """
+    results = [(None, None)] * len(prompts)
+    if not prompts:
+        return results
+    buffers = [TokenBuffer() for _ in prompts] if on_update is not None else None
+    shown = [0] * len(prompts)
+    with ThreadPoolExecutor(max_workers=max(1, min(max_in_flight, len(prompts)))) as pool:
+        futures = {
+            pool.submit(invoke_chain, chain, prompt,
+                        ([buffers[i]] if buffers else []) + list(callbacks or []) or None, cache, context_stats): i
+            for i, prompt in enumerate(prompts)
+        }
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=STREAM_REFRESH_SECONDS if buffers else None,
+                                 return_when=FIRST_COMPLETED)
+            if buffers:
+                for i, buffer in enumerate(buffers):
+                    count = len(buffer.tokens)
+                    if count != shown[i]:
+                        shown[i] = count
+                        on_update(i, buffer.text)
+            for future in done:
+                i = futures[future]
+                try:
+                    results[i] = (future.result(), None)
+                except Exception as e:
+                    results[i] = (None, e)
+                if on_complete is not None:
+                    on_complete(i, *results[i])
+    return results
+
+
+def generate_sections_single_call(chain, topics, prompt, cache=None, callbacks=None, context_stats=None):
+    """All sections from one retrieval pass and one structured-output call; returns [(text, error)] in topic order.
+
+    prompt is a SectionPrompt whose brief applies to every section, so it is
+    sent once rather than once per topic. Retrieval for all topics runs as
+    one batch and the de-duplicated union of documents, fitted to one
+    context budget per topic, is the context.
+    """
+    combine = getattr(chain, 'combine_documents_chain', None)
+    llm = combine.llm_chain.llm if combine is not None else chain
+    docs = []
+    retriever = getattr(chain, 'retriever', None)
+    if retriever is not None:
+        seen = set()
+        for topic_docs in retriever.batch(list(topics)):
+            for doc in topic_docs:
+                key = (doc.metadata.get("source"), doc.page_content)
+                if key not in seen:
+                    seen.add(key)
+                    docs.append(doc)
+
+    topic_list = "\n".join(f"{i + 1}. {topic}" for i, topic in enumerate(topics))
+    question = "\n\n".join(part for part in (prompt.brief, prompt.details) if part)
+    question += f"\n\nWrite one section for each of these topics, in this order:\n{topic_list}"
+    structured = llm.with_structured_output(GeneratedSections, method="json_schema")
+    budget = CONTEXT_TOKEN_BUDGET * max(1, len(topics))
+
+    def generate():
+        text = question
+        context = _assemble(docs, "\n".join(topics), llm, callbacks, context_stats, budget) if docs else []
+        if context:
+            excerpts = "\n\n".join(doc.page_content for doc in context)
+            text += f"\n\nUse the following excerpts from the company's documents where relevant:\n{excerpts}"
+        messages = [SystemMessage(content=prompt.system or DEFAULT_SYSTEM_PROMPT), HumanMessage(content=text)]
+        config = {"callbacks": callbacks} if callbacks else None
+        return structured.invoke(messages, config=config).model_dump_json()
+
+    try:
+        cache_text = f"{prompt.system or ''}\0{question}"
+        context_key = f"{context_hash(docs)}:{budget_key(budget)}"
+        raw = cache.call(llm, cache_text, generate, context_key) if cache is not None else generate()
+        sections = GeneratedSections.model_validate_json(raw).sections
+    except Exception as e:
+        return [(None, e)] * len(topics)
+
+    by_topic = {section.topic.strip().lower(): section.content for section in sections}
+    results = []
+    for i, topic in enumerate(topics):
+        content = by_topic.get(topic.strip().lower())
+        if content is None and i < len(sections):
+            # The model reworded the topic; fall back to position
+            content = sections[i].content
+        results.append((content, None) if content else (None, ValueError("missing from the model's response")))
+    return results
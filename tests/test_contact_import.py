@@ -0,0 +1,41 @@
+import datetime
+
+import pandas as pd
+
+from contact_import import prepare_contacts
+
+DEFAULT_DATE = datetime.date(2024, 1, 15)
+
+
+def make_sheet(**columns):
+    rows = len(next(iter(columns.values())))
+    base = {"Name": [f"Contact {i}" for i in range(rows)],
+            "Email": [f"c{i}@example.com" for i in range(rows)],
+            "Organization": [f"Org {i}" for i in range(rows)],
+            "CTA Link": ["https://example.com/book"] * rows}
+    return pd.DataFrame({**base, **columns})
+
+
+def test_mixed_date_formats_are_all_read():
+    sheet = make_sheet(**{"Demo Date": ["2024-03-01", "12/31/2024", "March 5, 2024", "", "not a date"]})
+    contacts, errors = prepare_contacts(sheet, DEFAULT_DATE)
+    assert [c["demo_date"] for c in contacts] == [
+        datetime.date(2024, 3, 1), datetime.date(2024, 12, 31), datetime.date(2024, 3, 5), DEFAULT_DATE]
+    assert errors.to_dict("records") == [{"row": 6, "email": "c4@example.com", "error": "unreadable demo date"}]
+
+
+def test_unknown_product_is_reported():
+    sheet = make_sheet(Product=["wipe all", "", "Wipe-O-Matic"])
+    contacts, errors = prepare_contacts(sheet, DEFAULT_DATE, default_product="AI-driven solution")
+    assert [c["product"] for c in contacts] == ["Wipe All", "AI-driven solution"]
+    assert errors.to_dict("records") == [{"row": 4, "email": "c2@example.com", "error": "unknown product"}]
+
+
+def test_duplicate_of_a_rejected_row_is_kept():
+    sheet = make_sheet(Name=["", "Contact 1", "Contact 2"], Email=["c1@example.com", "C1@example.com",
+                                                                    "c1@example.com"])
+    contacts, errors = prepare_contacts(sheet, DEFAULT_DATE)
+    assert [(c["name"], c["email"]) for c in contacts] == [("Contact 1", "C1@example.com")]
+    assert errors.to_dict("records") == [
+        {"row": 2, "email": "c1@example.com", "error": "missing name"},
+        {"row": 4, "email": "c1@example.com", "error": "duplicate email in file"}]
@@ -0,0 +1,79 @@
+import smtplib
+
+import pytest
+
+import email_sender
+from email_sender import SMTPBatchSender, SMTPDeliveryUncertain, build_message
+
+
+class FakeSMTP:
+    """Scripted server: fail_on maps a command to the connection numbers on which it hangs up"""
+
+    connections = 0
+    delivered = []
+    fail_on = {}
+
+    def __init__(self, host, port, timeout=None):
+        FakeSMTP.connections += 1
+        self.number = FakeSMTP.connections
+
+    def _maybe_drop(self, command):
+        if self.number in self.fail_on.get(command, ()):
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+
+    def starttls(self, context=None):
+        pass
+
+    def login(self, username, password):
+        pass
+
+    def ehlo_or_helo_if_needed(self):
+        pass
+
+    def mail(self, sender):
+        self._maybe_drop("mail")
+        return 250, b"OK"
+
+    def rcpt(self, rcpt):
+        return 250, b"OK"
+
+    def data(self, data):
+        FakeSMTP.delivered.append(data)
+        self._maybe_drop("data")
+        return 250, b"OK"
+
+    def rset(self):
+        return 250, b"OK"
+
+    def quit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def fake_smtp(monkeypatch):
+    FakeSMTP.connections = 0
+    FakeSMTP.delivered = []
+    monkeypatch.setattr(email_sender.smtplib, "SMTP", FakeSMTP)
+    return FakeSMTP
+
+
+def test_drop_before_data_reconnects_and_sends_once(fake_smtp):
+    fake_smtp.fail_on = {"mail": {1}}
+    msg, recipients = build_message("me@example.com", "you@example.com", "Hi", "Hello")
+    with SMTPBatchSender("smtp.example.com", 587, "me@example.com", "pw", rate=100) as sender:
+        sender.send(msg, recipients)
+    assert fake_smtp.connections == 2
+    assert len(fake_smtp.delivered) == 1
+
+
+def test_drop_during_data_is_uncertain_not_resent(fake_smtp):
+    fake_smtp.fail_on = {"data": {1}}
+    msg, recipients = build_message("me@example.com", "you@example.com", "Hi", "Hello")
+    with SMTPBatchSender("smtp.example.com", 587, "me@example.com", "pw", rate=100) as sender:
+        with pytest.raises(SMTPDeliveryUncertain):
+            sender.send(msg, recipients)
+    assert fake_smtp.connections == 1
+    assert len(fake_smtp.delivered) == 1
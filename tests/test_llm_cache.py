@@ -0,0 +1,32 @@
+from llm_cache import LLMResponseCache
+
+
+class FakeLLM:
+    model_name = "gpt-4o-mini"
+    temperature = 0.7
+
+
+def make_cache(tmp_path):
+    return LLMResponseCache(path=str(tmp_path / "llm.sqlite"), semantic_threshold=0.7)
+
+
+def test_personalized_scope_is_exact_match_only(tmp_path):
+    scope = make_cache(tmp_path).scope("followup", semantic=False)
+    scope.call(FakeLLM(), "Write a thank-you email to Jane Doe at Acme Golf", lambda: "Dear Jane")
+    reply = scope.call(FakeLLM(), "Write a thank-you email to John Doe at Acme Golf", lambda: "Dear John")
+    assert reply == "Dear John"
+
+
+def test_similar_grounded_prompt_is_served_from_cache(tmp_path):
+    scope = make_cache(tmp_path).scope("newsletter")
+    scope.call(FakeLLM(), "Summarize this week's product updates for the newsletter", lambda: "first", "ctx")
+    reply = scope.call(FakeLLM(), "Summarize this week's product updates for our newsletter", lambda: "second", "ctx")
+    assert reply == "first"
+    assert scope.cache.stats("newsletter")["semantic_hits"] == 1
+
+
+def test_ungrounded_prompt_is_never_served_by_similarity(tmp_path):
+    scope = make_cache(tmp_path).scope("newsletter")
+    scope.call(FakeLLM(), "Summarize this week's product updates for the newsletter", lambda: "first")
+    reply = scope.call(FakeLLM(), "Summarize this week's product updates for our newsletter", lambda: "second")
+    assert reply == "second"
@@ -0,0 +1,82 @@
+from email_sender import SMTPDeliveryUncertain
+from outbox import Outbox, account_key
+
+
+class FakeSender:
+    def __init__(self):
+        self.messages = []
+        self.sent = 0
+        self.connects = 1
+        self.messages_per_second = 0.0
+
+    def send(self, msg, recipients):
+        self.messages.append((msg["From"], recipients))
+        self.sent += 1
+
+    def close(self):
+        pass
+
+
+class FakeCRM:
+    def __init__(self):
+        self.activities = []
+
+    def find_or_create_deal(self, org):
+        return 7
+
+    def log_activity(self, deal_id, subject, note):
+        self.activities.append((deal_id, subject))
+
+
+def test_jobs_are_scoped_to_their_account(tmp_path):
+    path = str(tmp_path / "outbox.sqlite")
+    alice = Outbox(account_key("alice@example.com", "acme"), path)
+    bob = Outbox(account_key("bob@example.com", "globex"), path)
+    alice.enqueue("alice@example.com", "x@example.com", "X Corp", "Hi", "Hello")
+    bob.enqueue("bob@example.com", "y@example.com", "Y Corp", "Hi", "Hello")
+
+    sender, crm = FakeSender(), FakeCRM()
+    alice.drain(lambda: sender, crm)
+
+    assert [to for _, to in sender.messages] == [["x@example.com", "naware+deal7@pipedrivemail.com"]]
+    assert len(crm.activities) == 1
+    assert [job["to_addr"] for job in alice.jobs()] == ["x@example.com"]
+    assert alice.counts() == {"logged": 1}
+    assert bob.counts() == {"queued": 1}
+
+    bob._update(bob.jobs()[0]["key"], status="failed")
+    assert alice.requeue(("failed",)) == 0
+    assert bob.requeue(("failed",)) == 1
+
+
+def test_same_email_from_two_accounts_is_two_jobs(tmp_path):
+    path = str(tmp_path / "outbox.sqlite")
+    first = Outbox(account_key("alice@example.com", "acme"), path)
+    second = Outbox(account_key("alice@example.com", "globex"), path)
+    assert first.enqueue("alice@example.com", "x@example.com", "X", "Hi", "Hello") != \
+        second.enqueue("alice@example.com", "x@example.com", "X", "Hi", "Hello")
+    assert first.active() == second.active() == 1
+
+
+def test_sender_that_cannot_be_opened_fails_the_job(tmp_path):
+    outbox = Outbox(account_key("alice@example.com", "acme"), str(tmp_path / "outbox.sqlite"))
+    outbox.enqueue("alice@example.com", "x@example.com", "X Corp", "Hi", "Hello")
+
+    def open_sender():
+        raise ValueError("invalid literal for int() with base 10: 'abc'")
+
+    outbox.drain(open_sender, FakeCRM())
+    assert outbox.counts() == {"failed": 1}
+    assert outbox.busy() == 0
+
+
+def test_drop_during_data_marks_the_job_uncertain(tmp_path):
+    outbox = Outbox(account_key("alice@example.com", "acme"), str(tmp_path / "outbox.sqlite"))
+    outbox.enqueue("alice@example.com", "x@example.com", "X Corp", "Hi", "Hello")
+
+    class DroppingSender(FakeSender):
+        def send(self, msg, recipients):
+            raise SMTPDeliveryUncertain("connection lost during DATA")
+
+    outbox.drain(DroppingSender, FakeCRM())
+    assert outbox.counts() == {"uncertain": 1}
@@ -0,0 +1,85 @@
+import threading
+import time
+
+import pytest
+import requests
+
+import pipedrive_client
+from pipedrive_client import PipedriveClient, PipedriveError
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self.body = body if body is not None else {"success": status_code < 400, "data": None}
+        self.headers = headers or {}
+        self.reason = "scripted"
+
+    def json(self):
+        return self.body
+
+
+class FakeSession:
+    """Scripted session: script maps (method, path) to responses or exceptions, handed out in order"""
+
+    def __init__(self, script, delay=0.0):
+        self.script = {key: list(replies) for key, replies in script.items()}
+        self.delay = delay
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def request(self, method, url, timeout=None, **kwargs):
+        path = url.split("/api/v1/", 1)[1]
+        with self._lock:
+            self.calls.append((method, path))
+            replies = self.script[(method, path)]
+            reply = replies.pop(0) if len(replies) > 1 else replies[0]
+        time.sleep(self.delay)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(pipedrive_client.time, "sleep", lambda seconds: None)
+    return PipedriveClient("https://acme.pipedrive.com/api/v1", "token", rate=1000, burst=1000)
+
+
+@pytest.mark.parametrize("failure", [FakeResponse(503), requests.ReadTimeout("read timed out")])
+def test_post_is_not_retried_once_the_server_may_have_acted(client, failure):
+    client.session = FakeSession({("POST", "activities"): [failure, FakeResponse(201)]})
+    with pytest.raises(PipedriveError):
+        client.log_activity(7, "Hi", "Hello")
+    assert client.session.calls == [("POST", "activities")]
+
+
+def test_post_is_retried_after_429(client):
+    client.session = FakeSession({("POST", "activities"): [
+        FakeResponse(429, headers={"Retry-After": "1"}), FakeResponse(201, {"success": True, "data": {"id": 3}})]})
+    assert client.log_activity(7, "Hi", "Hello") == {"id": 3}
+    assert len(client.session.calls) == 2
+
+
+def test_get_is_retried_through_429_and_503(client):
+    client.session = FakeSession({("GET", "deals/search"): [
+        FakeResponse(429, headers={"Retry-After": "1"}), FakeResponse(503),
+        FakeResponse(200, {"success": True, "data": {"items": [{"item": {"id": 5, "title": "Acme Golf"}}]}})]})
+    assert client.search_deal("Acme Golf") == 5
+    assert len(client.session.calls) == 3
+
+
+def test_concurrent_sends_to_one_org_search_and_create_once(client):
+    client.session = FakeSession({
+        ("GET", "deals/search"): [FakeResponse(200, {"success": True, "data": {"items": []}})],
+        ("POST", "deals"): [FakeResponse(201, {"success": True, "data": {"id": 9, "title": "Acme Golf"}})],
+    }, delay=0.05)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(client.find_or_create_deal("Acme  golf")))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [9] * 8
+    assert sorted(client.session.calls) == [("GET", "deals/search"), ("POST", "deals")]
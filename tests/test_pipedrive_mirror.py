@@ -0,0 +1,52 @@
+import pytest
+
+from pipedrive_client import PipedriveClient
+from pipedrive_mirror import PipedriveMirror
+
+
+class EmptyClient:
+    def paginate(self, path, params=None):
+        return iter(())
+
+
+@pytest.fixture
+def mirror(tmp_path):
+    mirror = PipedriveMirror(EmptyClient(), str(tmp_path / "mirror.sqlite"))
+    mirror.upsert_orgs([{"id": 1, "name": "Acme Golf West"}, {"id": 2, "name": "Riverside Golf Course"},
+                        {"id": 3, "name": "Acme Golf, Inc."}])
+    mirror.upsert_deals([{"id": 11, "title": "Acme Golf West – Demo Follow-Up", "org_id": 1, "status": "open"},
+                         {"id": 12, "title": "Riverside Golf Course deal", "org_id": 2, "status": "open"},
+                         {"id": 13, "title": "Acme Golf – Demo Follow-Up", "org_id": 3, "status": "open"}])
+    return mirror
+
+
+def test_normalized_name_is_matched(mirror):
+    assert mirror.match("ACME Golf") == (13, 3)
+    assert mirror.candidates("ACME Golf") == []
+
+
+@pytest.mark.parametrize("org, similar_deal", [("Acme Golf East", 11), ("Riverside Golf Club", 12)])
+def test_similar_name_of_another_customer_is_only_a_candidate(mirror, org, similar_deal):
+    assert mirror.match(org) == (None, None)
+    assert similar_deal in [c["deal_id"] for c in mirror.candidates(org)]
+
+
+def test_remote_search_only_accepts_a_certain_match(mirror):
+    class SearchClient(PipedriveClient):
+        created = []
+
+        def _request(self, method, path, **kwargs):
+            if path == "deals/search":
+                return {"items": [{"item": {"id": 21, "title": "ACME Golf Club deal",
+                                            "organization": {"name": "ACME Golf Club"}}},
+                                  {"item": {"id": 22, "title": "Pinehurst – Demo Follow-Up",
+                                            "organization": None}}]}
+            self.created.append(kwargs["json"]["title"])
+            return {"id": 23, "title": kwargs["json"]["title"], "status": "open"}
+
+    client = SearchClient("http://pipedrive.test", "token", mirror=mirror)
+    assert client.search_deal("Acme Golf Club, Inc.") == 21
+    assert client.search_deal("Pinehurst") == 22
+    assert client.search_deal("Acme Golf Clubhouse") is None
+    assert client.find_or_create_deal("Acme Golf Clubhouse") == 23
+    assert client.created == ["Acme Golf Clubhouse – Demo Follow-Up"]
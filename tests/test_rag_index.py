@@ -0,0 +1,109 @@
+import pytest
+from langchain.schema import Document
+
+from local_retrieval import HashingEmbeddings
+import rag_index
+from rag_index import IncrementalVectorIndex, IndexRegistry
+
+
+def make_files(*names):
+    return {(name, f"hash-{name}"): [Document(page_content=f"{name} talks about {name} widgets and gadgets",
+                                              metadata={"source": name})]
+            for name in names}
+
+
+class FailingEmbeddings(HashingEmbeddings):
+    def embed_documents(self, texts):
+        raise RuntimeError("embedding service unavailable")
+
+
+def indexed_sources(index):
+    return {doc.metadata["source"] for doc in index.vectorstore.docstore._dict.values()}
+
+
+@pytest.mark.parametrize("factory", ["Flat", "HNSW32", "IVF4,Flat", "PCA32,IVF4,Flat"])
+def test_removed_file_stays_removed_after_resync(factory, monkeypatch):
+    monkeypatch.setattr(rag_index, "INDEX_MIN_TRAIN", 0)
+    embeddings = HashingEmbeddings(dim=64)
+    index = IncrementalVectorIndex(index_dir="", index_factory=factory)
+    others = [f"file{i}" for i in range(40)]
+    index.sync(make_files("alpha", "beta", "gamma", *others), embeddings)
+    assert factory == "Flat" or type(index.vectorstore.index).__name__ != "IndexFlatL2"
+
+    files = make_files("alpha", "gamma", "delta", *others)
+    added, removed = index.sync(files, embeddings)
+    assert (added, removed) == ([("delta", "hash-delta")], [("beta", "hash-beta")])
+    assert index.sources == sorted(["alpha", "delta", "gamma", *others])
+    assert indexed_sources(index) == {"alpha", "delta", "gamma", *others}
+
+    assert index.sync(files, embeddings) == ([], [])
+    docs = index.as_retriever(k=4).invoke("beta widgets")
+    assert "beta" not in {doc.metadata["source"] for doc in docs}
+    docs = index.as_retriever(sources=["gamma"], k=4).invoke("widgets")
+    assert [doc.metadata["source"] for doc in docs] == ["gamma"]
+    docs = index.as_retriever(k=1).invoke("delta talks about delta widgets and gadgets")
+    assert [doc.metadata["source"] for doc in docs] == ["delta"]
+
+
+def test_flat_fallback_is_trained_once_the_corpus_is_big_enough(monkeypatch):
+    monkeypatch.setattr(rag_index, "INDEX_MIN_TRAIN", 30)
+    embeddings = HashingEmbeddings(dim=64)
+    index = IncrementalVectorIndex(index_dir="", index_factory="IVF4,Flat")
+    files = make_files(*(f"file{i}" for i in range(20)))
+    index.sync(files, embeddings)
+    assert type(index.vectorstore.index).__name__ == "IndexFlatL2"
+
+    files.update(make_files(*(f"file{i}" for i in range(20, 40))))
+    index.sync(files, embeddings)
+    assert type(index.vectorstore.index).__name__ == "IndexIVFFlat"
+    assert indexed_sources(index) == {f"file{i}" for i in range(40)}
+
+
+def test_failed_embedding_leaves_index_retryable():
+    embeddings = HashingEmbeddings(dim=64)
+    index = IncrementalVectorIndex(index_dir="", index_factory="HNSW32")
+    index.sync(make_files("alpha", "beta"), embeddings)
+
+    files = make_files("alpha", "delta")
+    with pytest.raises(RuntimeError):
+        index.sync(files, FailingEmbeddings(dim=64))
+    assert index.sources == ["alpha", "beta"]
+    assert indexed_sources(index) == {"alpha", "beta"}
+    assert {doc.metadata["source"] for doc in index.bm25.docs.values()} == {"alpha", "beta"}
+
+    index.sync(files, embeddings)
+    assert index.sources == ["alpha", "delta"]
+    assert indexed_sources(index) == {"alpha", "delta"}
+
+
+def test_hybrid_index_without_vectors_does_not_fall_back_to_bm25():
+    index = IncrementalVectorIndex(index_dir="")
+    with pytest.raises(RuntimeError):
+        index.sync(make_files("alpha"), FailingEmbeddings(dim=64))
+    assert index.empty
+
+    index.bm25.add("alpha|hash-alpha|0", Document(page_content="alpha widgets", metadata={"source": "alpha"}))
+    with pytest.raises(ValueError):
+        index.as_retriever(mode="hybrid")
+
+
+@pytest.mark.parametrize("factory", ["Flat", "HNSW32", "HNSW32,SQ8", "PCA32,HNSW32", "IVF4,Flat", "PQ8x4"])
+def test_source_filtered_search(factory, monkeypatch):
+    monkeypatch.setattr(rag_index, "INDEX_MIN_TRAIN", 0)
+    index = IncrementalVectorIndex(index_dir="", index_factory=factory)
+    index.sync(make_files(*(f"file{i}" for i in range(60))), HashingEmbeddings(dim=64))
+    assert factory == "Flat" or type(index.vectorstore.index).__name__ != "IndexFlatL2"
+
+    docs = index.as_retriever(sources=["file3", "file7"], k=4).invoke("file3 widgets")
+    assert docs and {doc.metadata["source"] for doc in docs} <= {"file3", "file7"}
+
+
+def test_source_filter_on_a_store_shared_through_the_registry():
+    registry = IndexRegistry()
+    files = make_files("alpha", "beta", "gamma")
+    IncrementalVectorIndex(index_dir="", registry=registry).sync(files, HashingEmbeddings(dim=64))
+
+    index = IncrementalVectorIndex(index_dir="", registry=registry)
+    index.sync(files, HashingEmbeddings(dim=64))
+    docs = index.as_retriever(sources=["beta"], k=4).invoke("widgets")
+    assert [doc.metadata["source"] for doc in docs] == ["beta"]